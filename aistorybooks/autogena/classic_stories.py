@@ -1,8 +1,5 @@
-import chromadb
-from autogen.agentchat.contrib.retrieve_user_proxy_agent import RetrieveUserProxyAgent
 from pathlib import Path
 
-import autogen
 from config import Config
 
 config_list = [
@@ -26,6 +23,11 @@ class Classics2StoryBookGenerator:
         self.summary_size = summary_size
         self.writing_style = writing_style
 
+        # autogen and chromadb are slow to import, they are only loaded when a generator is created
+        import autogen
+        import chromadb
+        from autogen.agentchat.contrib.retrieve_user_proxy_agent import RetrieveUserProxyAgent
+
         self.llm_config = {"config_list": config_list, "cache_seed": 42}
         self.human_admin = autogen.UserProxyAgent(
             name="Admin",
@@ -0,0 +1,61 @@
+import json
+import shutil
+from pathlib import Path
+from typing import Optional, Dict, Any
+
+from aistorybooks.cache import ResponseCache
+from aistorybooks.config import Config
+from aistorybooks.osutils import write_atomic
+
+
+class RunCheckpoint:
+    """
+    Persists the completed chunk results of a storybook run, so an interrupted run can be resumed.
+
+    Each run gets its own directory, named by the hash of the PDF content and the generation parameters,
+    with one JSON file per completed chunk.
+    """
+
+    def __init__(self, run_dir: Path):
+        self.run_dir = Path(run_dir)
+
+    @classmethod
+    def for_run(cls, pdf_hash: str, params: Dict[str, Any], root_dir: Optional[Path] = None) -> "RunCheckpoint":
+        root_dir = Path(root_dir) if root_dir else Config.CACHE_DIR.joinpath("runs")
+        run_dir = root_dir.joinpath(ResponseCache.make_key(pdf_hash, json.dumps(params, sort_keys=True)))
+        checkpoint = cls(run_dir)
+        if not run_dir.joinpath("run.json").exists():
+            checkpoint._write_json(run_dir.joinpath("run.json"), {"pdf_hash": pdf_hash, "params": params})
+        return checkpoint
+
+    @staticmethod
+    def _write_json(file: Path, data: Dict[str, Any]):
+        file.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(file, json.dumps(data))
+
+    def _chunk_file(self, index: int) -> Path:
+        return self.run_dir.joinpath(f"chunk_{index:05d}.json")
+
+    def save(self, index: int, start_page, end_page, content: str):
+        self._write_json(self._chunk_file(index),
+                         {"index": index, "start_page": start_page, "end_page": end_page, "content": content})
+
+    def load(self, index: int, start_page=None, end_page=None) -> Optional[str]:
+        """Returns the saved content of the chunk, if it was completed for the same page range."""
+        chunk_file = self._chunk_file(index)
+        if not chunk_file.exists():
+            return None
+        data = json.loads(chunk_file.read_text(encoding="utf-8"))
+        if (data["start_page"], data["end_page"]) != (start_page, end_page):
+            return None
+        return data["content"]
+
+    def completed(self) -> int:
+        return len(list(self.run_dir.glob("chunk_*.json")))
+
+    def clear(self):
+        for chunk_file in self.run_dir.glob("chunk_*.json"):
+            chunk_file.unlink()
+
+    def delete(self):
+        shutil.rmtree(self.run_dir, ignore_errors=True)
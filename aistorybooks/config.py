@@ -15,6 +15,22 @@ def _load_api_key(filename: str, env_var: str = None) -> str | None:
         return None
 
 
+class _ApiKey:
+    """Config attribute loading the API key on first access, a missing key is only reported when it is used."""
+
+    def __init__(self, filename: str, env_var: str = None):
+        self.filename = filename
+        self.env_var = env_var
+        self._loaded = False
+        self._value = None
+
+    def __get__(self, instance, owner) -> str | None:
+        if not self._loaded:
+            self._value = _load_api_key(self.filename, env_var=self.env_var)
+            self._loaded = True
+        return self._value
+
+
 class Config:
     GROQ_API_BASE_URL = "https://api.groq.com/openai/v1"
     GROQ_MODEL_NAME = "llama3-70b-8192"
@@ -22,7 +38,13 @@ class Config:
     OPENAI_MODEL_NAME = "gpt-4"
     OPENAI_MODEL_GPT_4O_MINI_NAME = "gpt-4o-mini"
     GEMINI_MODEL_NAME = "gemini-2.0-flash-lite"
-    GROQ_API_KEY = _load_api_key("groq-api-key.txt")
-    OPENAI_API_KEY = _load_api_key("openai-api-key.txt")
-    LOCAL_LLM_API_KEY = _load_api_key("local-api-key.txt")
-    GEMINI_API_KEY = _load_api_key("gemini-api-key.txt", env_var="GOOGLE_API_KEY")
+    GROQ_API_KEY = _ApiKey("groq-api-key.txt")
+    OPENAI_API_KEY = _ApiKey("openai-api-key.txt")
+    LOCAL_LLM_API_KEY = _ApiKey("local-api-key.txt")
+    GEMINI_API_KEY = _ApiKey("gemini-api-key.txt", env_var="GOOGLE_API_KEY")
+    # free tier quotas, used by aistorybooks.ratelimit.RateLimiter.for_model
+    RATE_LIMITS = {
+        GEMINI_MODEL_NAME: {"requests_per_minute": 30, "tokens_per_minute": 1_000_000},
+        GROQ_MODEL_NAME: {"requests_per_minute": 30, "tokens_per_minute": 6_000},
+    }
+    CACHE_DIR = Path(os.environ.get("AISTORYBOOKS_CACHE_DIR", Path.home().joinpath(".cache", "aistorybooks")))
@@ -7,6 +7,7 @@ from crewai import LLM
 from crewai.agents.agent_builder.base_agent import BaseAgent
 
 from config import Config  # Assuming you have a config.py file
+from httpclients import HttpClients
 from tools import ImageGenerator, MarkdownToPdfConverter
 
 
@@ -39,6 +40,7 @@ class ClassicPoemGenerator:
 
     def _initialize_llm(self) -> LLM:
         """Initializes the language model."""
+        HttpClients.share_with_litellm()
         return LLM(
             model="groq/" + Config.GROQ_MODEL_NAME,
             api_key=Config.GROQ_API_KEY,
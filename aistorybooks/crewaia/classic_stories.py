@@ -7,6 +7,7 @@ from crewai import LLM
 from crewai.agents.agent_builder.base_agent import BaseAgent
 
 from config import Config  # Assuming you have a config.py file
+from httpclients import HttpClients
 from tools import ImageGenerator
 
 
@@ -48,6 +49,7 @@ class StoryBookGenerator:
 
     def _initialize_llm(self) -> LLM:
         """Initializes the language model."""
+        HttpClients.share_with_litellm()
         return LLM(
             model="openai/" + Config.OPENAI_MODEL_NAME,
             api_key=Config.OPENAI_API_KEY,
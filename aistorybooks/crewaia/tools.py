@@ -1,15 +1,23 @@
+import hashlib
 import markdown
 import os
 import pdfkit
+import pymupdf
 import re
-import requests
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import Type
+from typing import Type, List, Dict, Any, ClassVar, Iterator
 
 from config import Config
 from crewai.tools import BaseTool
+from httpclients import HttpClients
+from imagestore import ImageStore
 
 
 class ImageGeneratorInput(BaseModel):
@@ -33,49 +41,118 @@ class ImageGenerator(BaseTool):
     )
     args_schema: Type[BaseModel] = ImageGeneratorInput
     client: OpenAI = Field(
-        default_factory=lambda: OpenAI(api_key=Config.OPENAI_API_KEY),
-        description="OpenAI client instance.",
+        default_factory=lambda: HttpClients.openai_client(api_key=Config.OPENAI_API_KEY),
+        description="OpenAI client instance, shared by all tool instances.",
     )
+    max_concurrency: int = Field(
+        default=4,
+        description="Number of images generated and downloaded at the same time by `generate_batch`.",
+    )
+    image_store: ImageStore = Field(
+        default_factory=lambda: ImageStore(Config.CACHE_DIR.joinpath("images")),
+        description="Store of the generated images, the same prompt and settings are only generated once.",
+    )
+    image_model: str = "dall-e-3"
+    image_size: str = "1024x1024"
+    image_quality: str = "standard"
 
     model_config = ConfigDict(arbitrary_types_allowed=True)
 
-    def _run(self, image_description: str) -> str:
-        if len(image_description) < 100:
-            raise ValueError("Please provide a longer image description (at least 100 characters).")
+    @staticmethod
+    def _image_path(image_description: str, key: str) -> Path:
+        words = image_description.split()[:5]
+        safe_words = [re.sub(r"[^a-zA-Z0-9_]", "", word) for word in words]
+        # the key suffix keeps descriptions starting with the same words apart
+        filename = "_".join(safe_words + [key[:12]]).lower() + ".png"
+        return Path(os.getcwd()).joinpath("images", filename)
+
+    @staticmethod
+    def _prompt(image_description: str) -> str:
+        return (f"Image is about: {image_description}. "
+                f"Style: Illustration. Create an illustration incorporating a vivid palette with an emphasis on shades "
+                f"of azure and emerald, augmented by splashes of gold for contrast and visual interest. The style "
+                f"should evoke the intricate detail and whimsy of early 20th-century storybook illustrations, "
+                f"blending realism with fantastical elements to create a sense of wonder and enchantment. The "
+                f"composition should be rich in texture, with a soft, luminous lighting that enhances the magical "
+                f"atmosphere. Attention to the interplay of light and shadow will add depth and dimensionality, "
+                f"inviting the viewer to delve into the scene. DON'T include ANY text in this image. DON'T include "
+                f"colour palettes in this image.")
 
+    def _image_key(self, image_description: str) -> str:
+        return ImageStore.make_key(self._prompt(image_description), self.image_model, self.image_size,
+                                   self.image_quality)
+
+    def _generate_image_url(self, image_description: str) -> str:
         response = self.client.images.generate(
-            model="dall-e-3",
-            prompt=f"Image is about: {image_description}. "
-                   f"Style: Illustration. Create an illustration incorporating a vivid palette with an emphasis on shades "
-                   f"of azure and emerald, augmented by splashes of gold for contrast and visual interest. The style "
-                   f"should evoke the intricate detail and whimsy of early 20th-century storybook illustrations, "
-                   f"blending realism with fantastical elements to create a sense of wonder and enchantment. The "
-                   f"composition should be rich in texture, with a soft, luminous lighting that enhances the magical "
-                   f"atmosphere. Attention to the interplay of light and shadow will add depth and dimensionality, "
-                   f"inviting the viewer to delve into the scene. DON'T include ANY text in this image. DON'T include "
-                   f"colour palettes in this image.",
-            size="1024x1024",
-            quality="standard",
+            model=self.image_model,
+            prompt=self._prompt(image_description),
+            size=self.image_size,
+            quality=self.image_quality,
             n=1,
         )
+        return response.data[0].url
 
-        image_url = response.data[0].url
-        words = image_description.split()[:5]
-        safe_words = [re.sub(r"[^a-zA-Z0-9_]", "", word) for word in words]
-        filename = "_".join(safe_words).lower() + ".png"
-        filepath = Path(os.getcwd()).joinpath("images", filename)
-
-        # Download the image from the URL
-        image_response = requests.get(image_url)
-        if image_response.status_code == 200:
-            print(f"Saving image: {filepath.as_posix()}")
-            filepath.write_bytes(image_response.content)
-        else:
-            print("Failed to download the image.")
-            return ""
+    @staticmethod
+    def _download(image_url: str, filepath: Path) -> bool:
+        """Streams the image to disk in chunks, the file only appears once it is complete."""
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = filepath.with_name(f".{filepath.name}.{threading.get_ident()}.part")
+        try:
+            with HttpClients.httpx_client().stream("GET", image_url, timeout=60) as image_response:
+                if image_response.status_code != 200:
+                    return False
+                with open(temp_file, "wb") as f:
+                    for data in image_response.iter_bytes(chunk_size=64 * 1024):
+                        f.write(data)
+            os.replace(temp_file, filepath)
+            return True
+        finally:
+            if temp_file.exists():
+                temp_file.unlink()
 
+    def _run(self, image_description: str) -> str:
+        if len(image_description) < 100:
+            raise ValueError("Please provide a longer image description (at least 100 characters).")
+
+        key = self._image_key(image_description)
+        filepath = self._image_path(image_description, key)
+        stored = self.image_store.get(key)
+        if stored is None:
+            image_url = self._generate_image_url(image_description)
+            # Download the image from the URL, over the shared connection pool
+            if not self._download(image_url, self.image_store.file_path(key)):
+                print("Failed to download the image.")
+                return ""
+            stored = self.image_store.add(key)
+
+        print(f"Saving image: {filepath.as_posix()}")
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(stored, filepath)
         return filepath.relative_to(os.getcwd()).as_posix()
 
+    def _run_in_batch(self, image_description: str) -> str:
+        try:
+            return self._run(image_description)
+        except Exception as e:
+            # the other images of the batch are already paid for, keep them
+            print(f"Failed to generate the image: {e}")
+            return ""
+
+    def generate_batch(self, image_descriptions: List[str]) -> List[str]:
+        """
+        Generates the images of several descriptions concurrently, at most `max_concurrency` at a time, and
+        returns their paths in the order of the descriptions. An image that fails to generate or download gets
+        an empty path, without failing the rest of the batch.
+        """
+        for image_description in image_descriptions:
+            if len(image_description) < 100:
+                raise ValueError("Please provide a longer image description (at least 100 characters).")
+        if not image_descriptions:
+            return []
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_concurrency, len(image_descriptions))),
+                                thread_name_prefix="image_generator") as executor:
+            return list(executor.map(self._run_in_batch, image_descriptions))
+
 
 class MarkdownToPdfConverterInput(BaseModel):
     """Input schema for MarkdownToPdfConverter."""
@@ -96,17 +173,132 @@ class MarkdownToPdfConverter(BaseTool):
         "The input should be a valid path to a markdown file."
     )
     args_schema: Type[BaseModel] = MarkdownToPdfConverterInput
+    max_workers: int = Field(
+        default=4,
+        description="Number of PDFs rendered at the same time by `convert_batch`.",
+    )
+    stream_sections: bool = Field(
+        default=False,
+        description=(
+            "Renders long documents section by section and joins the parts, keeps memory use flat. Every section "
+            "starts on a new page: sections start at `#` and `##` headings, so chapters start on a new page. "
+            "Reference links and footnotes have to be defined in the section using them."
+        ),
+    )
+    max_section_chars: int = Field(
+        default=1_000_000,
+        description=(
+            "Sections longer than this are split at the next paragraph when `stream_sections` is set, the split "
+            "starts a new page in the middle of the section. Only meant to bound the memory use of huge sections."
+        ),
+    )
     model_config = ConfigDict(arbitrary_types_allowed=True)
 
-    def _run(self, markdown_file_name: str) -> str:
-        output_file = os.path.splitext(markdown_file_name)[0] + ".pdf"
+    PDF_OPTIONS: ClassVar[Dict[str, str]] = {"enable-local-file-access": ""}
+
+    @staticmethod
+    def _hash_file(output_file: str) -> Path:
+        output_path = Path(output_file)
+        return output_path.with_name(f".{output_path.name}.sha256")
 
-        # Read the markdown file
+    def _markdown_hash(self, markdown_file_name: str) -> str:
+        # every option changing the rendered PDF is part of the hash
+        options = (sorted(self.PDF_OPTIONS.items()), self.stream_sections, self.max_section_chars)
+        digest = hashlib.sha256(f"{options}\n".encode("utf-8"))
+        with open(markdown_file_name, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _iter_sections(self, markdown_file_name: str) -> Iterator[str]:
+        """
+        Reads the markdown line by line and yields it section by section. A section starts at a chapter heading,
+        or at a paragraph when the previous section is oversized, over `max_section_chars`.
+        """
+        lines: List[str] = []
+        chars = 0
         with open(Path(markdown_file_name), "r") as f:
-            text = f.read()
-        # Convert to HTML
-        html = markdown.markdown(text)
-        # Convert to PDF
-        pdfkit.from_string(html, output_file, options={"enable-local-file-access": ""})
+            for line in f:
+                is_heading = re.match(r"#{1,2}\s", line) is not None
+                if lines and (is_heading or (chars > self.max_section_chars and not line.strip())):
+                    yield "".join(lines)
+                    lines, chars = [], 0
+                lines.append(line)
+                chars += len(line)
+        if lines:
+            yield "".join(lines)
+
+    def _render_sections(self, markdown_file_name: str, output_file: str):
+        """
+        Renders every section to its own PDF and appends it to the output with incremental saves, the pages are
+        copied without re-encoding and only one section is held in memory at a time.
+        """
+        output_path = Path(output_file)
+        with tempfile.TemporaryDirectory(dir=output_path.parent) as temp_dir:
+            merged_file = Path(temp_dir).joinpath("merged.pdf")
+            part_file = Path(temp_dir).joinpath("part.pdf").as_posix()
+            for section in self._iter_sections(markdown_file_name):
+                if not section.strip():
+                    continue
+                pdfkit.from_string(markdown.markdown(section), part_file, options=self.PDF_OPTIONS)
+                if not merged_file.exists():
+                    os.replace(part_file, merged_file)
+                    continue
+                with pymupdf.open(merged_file) as merged, pymupdf.open(part_file) as part:
+                    merged.insert_pdf(part)
+                    merged.saveIncr()
+            if not merged_file.exists():
+                raise ValueError(f"Markdown file {markdown_file_name} is empty")
+            os.replace(merged_file, output_path)
+
+    def _convert(self, markdown_file_name: str, force: bool = False) -> Dict[str, Any]:
+        """Renders one markdown file, skipped when its PDF was rendered from the same markdown and options."""
+        started_at = time.perf_counter()
+        output_file = os.path.splitext(markdown_file_name)[0] + ".pdf"
+
+        digest = self._markdown_hash(markdown_file_name)
+        hash_file = self._hash_file(output_file)
+        skipped = (not force and Path(output_file).exists() and hash_file.exists()
+                   and hash_file.read_text(encoding="utf-8") == digest)
+        if not skipped and self.stream_sections:
+            self._render_sections(markdown_file_name, output_file)
+            hash_file.write_text(digest, encoding="utf-8")
+        elif not skipped:
+            # Read the markdown file
+            with open(Path(markdown_file_name), "r") as f:
+                text = f.read()
+            # Convert to HTML
+            html = markdown.markdown(text)
+            # Convert to PDF
+            pdfkit.from_string(html, output_file, options=self.PDF_OPTIONS)
+            hash_file.write_text(digest, encoding="utf-8")
+
+        return {"markdown_file": markdown_file_name, "pdf_file": output_file, "skipped": skipped,
+                "seconds": round(time.perf_counter() - started_at, 3)}
+
+    def _run(self, markdown_file_name: str) -> str:
+        return self._convert(markdown_file_name)["pdf_file"]
+
+    def convert_batch(self, markdown_file_names: List[str], force: bool = False) -> List[Dict[str, Any]]:
+        """
+        Converts many markdown files, up to `max_workers` wkhtmltopdf processes at the same time. Files whose
+        markdown didn't change since their PDF was rendered are skipped, unless `force` is set.
+
+        Returns one result per file, in the given order, with the `pdf_file`, whether it was `skipped`, the
+        `seconds` it took and the `error` of a failed conversion.
+        """
+
+        def convert(markdown_file_name: str) -> Dict[str, Any]:
+            started_at = time.perf_counter()
+            try:
+                return {**self._convert(markdown_file_name, force=force), "error": None}
+            except Exception as e:
+                return {"markdown_file": markdown_file_name, "pdf_file": None, "skipped": False,
+                        "seconds": round(time.perf_counter() - started_at, 3), "error": str(e)}
 
-        return output_file
+        if not markdown_file_names:
+            return []
+        # pdfkit runs wkhtmltopdf as a subprocess, threads are enough to render in parallel
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(markdown_file_names))),
+                                thread_name_prefix="markdown_to_pdf") as executor:
+            return list(executor.map(convert, markdown_file_names))
@@ -0,0 +1,121 @@
+import asyncio
+import importlib.util
+import os
+import threading
+import weakref
+from typing import Dict, Optional, Tuple, Any
+
+import httpx
+
+
+class HttpClients:
+    """
+    Process-wide registry of pooled HTTP clients, shared by the model clients, the tools and the image downloads
+    so connections and TLS sessions are reused instead of every model or tool instance opening its own.
+
+    Pool limits come from `configure` or the environment: AISTORYBOOKS_HTTP_MAX_CONNECTIONS,
+    AISTORYBOOKS_HTTP_MAX_KEEPALIVE, AISTORYBOOKS_HTTP_KEEPALIVE_EXPIRY and AISTORYBOOKS_HTTP2, HTTP/2 is used
+    when enabled and the h2 package is installed.
+    """
+    max_connections: int = int(os.environ.get("AISTORYBOOKS_HTTP_MAX_CONNECTIONS", 100))
+    max_keepalive_connections: int = int(os.environ.get("AISTORYBOOKS_HTTP_MAX_KEEPALIVE", 20))
+    keepalive_expiry: float = float(os.environ.get("AISTORYBOOKS_HTTP_KEEPALIVE_EXPIRY", 30))
+    http2: bool = os.environ.get("AISTORYBOOKS_HTTP2", "").lower() in ("1", "true", "yes")
+    timeout: float = 600
+
+    _httpx_clients: Dict[bool, httpx.Client] = {}
+    _openai_clients: Dict[Tuple[Optional[str], Optional[str], bool], Any] = {}
+    _async_httpx_clients: Dict[bool, "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]"] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, max_connections: Optional[int] = None, max_keepalive_connections: Optional[int] = None,
+                  keepalive_expiry: Optional[float] = None, http2: Optional[bool] = None,
+                  timeout: Optional[float] = None):
+        """
+        Changes the pool settings of the clients returned from now on. Clients handed out before keep serving
+        the models and tools holding them with the old settings, they are not closed.
+        """
+        with cls._lock:
+            for name, value in (("max_connections", max_connections),
+                                ("max_keepalive_connections", max_keepalive_connections),
+                                ("keepalive_expiry", keepalive_expiry), ("http2", http2), ("timeout", timeout)):
+                if value is not None:
+                    setattr(cls, name, value)
+            cls._httpx_clients.clear()
+            cls._openai_clients.clear()
+            cls._async_httpx_clients.clear()
+
+    @classmethod
+    def _use_http2(cls) -> bool:
+        return cls.http2 and importlib.util.find_spec("h2") is not None
+
+    @classmethod
+    def _client_settings(cls) -> Dict[str, Any]:
+        return dict(
+            timeout=httpx.Timeout(cls.timeout, connect=10),
+            limits=httpx.Limits(max_connections=cls.max_connections,
+                                max_keepalive_connections=cls.max_keepalive_connections,
+                                keepalive_expiry=cls.keepalive_expiry),
+            follow_redirects=True,
+        )
+
+    @classmethod
+    def httpx_client(cls, verify: bool = True) -> httpx.Client:
+        """Returns the shared httpx client, `verify=False` gets a separate pool that skips TLS verification."""
+        with cls._lock:
+            client = cls._httpx_clients.get(verify)
+            if client is None or client.is_closed:
+                client = httpx.Client(verify=verify, http2=cls._use_http2(), **cls._client_settings())
+                cls._httpx_clients[verify] = client
+            return client
+
+    @classmethod
+    def openai_client(cls, api_key: Optional[str] = None, base_url: Optional[str] = None, verify: bool = True):
+        """Returns a shared OpenAI client per api key and base url, on top of the shared httpx client."""
+        from openai import OpenAI
+
+        key = (api_key, base_url, verify)
+        http_client = cls.httpx_client(verify=verify)
+        with cls._lock:
+            client = cls._openai_clients.get(key)
+            if client is None:
+                client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+                cls._openai_clients[key] = client
+            return client
+
+    @classmethod
+    def async_httpx_client(cls, verify: bool = True) -> httpx.AsyncClient:
+        """
+        Returns the shared async httpx client of the running event loop, async connections can't be shared
+        between event loops.
+        """
+        loop = asyncio.get_running_loop()
+        with cls._lock:
+            clients = cls._async_httpx_clients.setdefault(verify, weakref.WeakKeyDictionary())
+            client = clients.get(loop)
+            if client is None or client.is_closed:
+                client = httpx.AsyncClient(verify=verify, http2=cls._use_http2(), **cls._client_settings())
+                clients[loop] = client
+            return client
+
+    @classmethod
+    def share_with_litellm(cls):
+        """Makes litellm, the model client of crewai, send its requests over the shared httpx client."""
+        import litellm
+
+        litellm.client_session = cls.httpx_client()
+
+    @classmethod
+    def close(cls):
+        """
+        Closes all shared clients, for the shutdown of the process. Models and tools still holding a client can't
+        send requests with it anymore, `httpx_client` and `openai_client` return new ones.
+        """
+        with cls._lock:
+            for client in cls._httpx_clients.values():
+                client.close()
+            cls._httpx_clients.clear()
+            cls._openai_clients.clear()
+            # async clients are closed with their event loop, they can't be closed from another one
+            cls._async_httpx_clients.clear()
@@ -0,0 +1,99 @@
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Dict, Any
+
+from aistorybooks.cache import ResponseCache
+from aistorybooks.osutils import write_atomic
+
+
+class ImageStore:
+    """
+    Content addressed store of generated images, keyed by everything that determines the image: the full
+    prompt, the model, the size and the quality. A stored image is served without calling the image API.
+
+    Images are kept as `<key>.png` files next to an `index.json` recording their size and last access. The
+    least recently used images are evicted when the store grows over `max_entries` or `max_size_bytes`.
+    """
+    INDEX_FILE = "index.json"
+
+    def __init__(self, root_dir: Path, max_entries: int = 1_000, max_size_bytes: int = 1024 * 1024 * 1024):
+        self.root_dir = Path(root_dir)
+        self.max_entries = max_entries
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        self._index: Dict[str, Dict[str, Any]] = self._load_index()
+
+    make_key = staticmethod(ResponseCache.make_key)
+
+    def file_path(self, key: str) -> Path:
+        """Returns where the image of `key` is stored, write the image there and call `add` to store it."""
+        return self.root_dir.joinpath(f"{key}.png")
+
+    def _load_index(self) -> Dict[str, Dict[str, Any]]:
+        index_file = self.root_dir.joinpath(self.INDEX_FILE)
+        if not index_file.exists():
+            return {}
+        try:
+            index = json.loads(index_file.read_text(encoding="utf-8"))
+        except ValueError:
+            # a damaged index only costs regenerating the images
+            return {}
+        return {key: entry for key, entry in index.items() if self.file_path(key).exists()}
+
+    def _save_index(self):
+        write_atomic(self.root_dir.joinpath(self.INDEX_FILE), json.dumps(self._index))
+
+    def get(self, key: str) -> Optional[Path]:
+        """Returns the stored image of `key`, None when it has to be generated."""
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None or not self.file_path(key).exists():
+                self._index.pop(key, None)
+                self.misses += 1
+                return None
+            entry["accessed_at"] = time.time()
+            # the index is kept in least recently used order, saved with the next insert or eviction
+            self._index[key] = self._index.pop(key)
+            self.hits += 1
+            return self.file_path(key)
+
+    def add(self, key: str) -> Path:
+        """Records the image written to `file_path(key)` and evicts the least recently used images if needed."""
+        path = self.file_path(key)
+        now = time.time()
+        with self._lock:
+            self._index.pop(key, None)
+            self._index[key] = {"size": path.stat().st_size, "created_at": now, "accessed_at": now}
+            self._evict(keep=key)
+            self._save_index()
+        return path
+
+    def _evict(self, keep: str):
+        entries = len(self._index)
+        size = sum(entry["size"] for entry in self._index.values())
+        for key, entry in list(self._index.items()):
+            if entries <= self.max_entries and size <= self.max_size_bytes:
+                break
+            if key == keep:
+                continue
+            self.file_path(key).unlink(missing_ok=True)
+            del self._index[key]
+            entries -= 1
+            size -= entry["size"]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._index),
+                    "size_bytes": sum(entry["size"] for entry in self._index.values())}
+
+    def clear(self):
+        with self._lock:
+            for key in self._index:
+                self.file_path(key).unlink(missing_ok=True)
+            self._index.clear()
+            self._save_index()
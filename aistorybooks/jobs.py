@@ -0,0 +1,244 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Optional, Dict, Any
+
+from aistorybooks.config import Config
+from aistorybooks.osutils import write_atomic, spawn_process_pool
+from aistorybooks.storybook import StorybookBuffer
+from aistorybooks.telemetry import TelemetrySummary, TelemetrySinks, JsonlTelemetrySink
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+# running or queued job of an earlier process, it can be submitted again to resume from its checkpoint
+INTERRUPTED = "interrupted"
+FINISHED_STATES = (COMPLETED, FAILED, CANCELLED, INTERRUPTED)
+
+
+class _JobFiles:
+    """
+    Files of one job: `job.json` with the state and progress, the input PDF, `story.md` with the completed
+    chunks, `partial.md` with the streamed text of the chunk in progress, `telemetry.jsonl` with the telemetry of
+    every chunk and a `cancel` marker.
+    """
+
+    JOB_FILE = "job.json"
+
+    def __init__(self, job_dir: Path):
+        self.job_dir = Path(job_dir)
+        self.job_file = self.job_dir.joinpath(self.JOB_FILE)
+        self.story = StorybookBuffer(self.job_dir.joinpath("story.md"))
+        self.partial_file = self.job_dir.joinpath("partial.md")
+        self.cancel_file = self.job_dir.joinpath("cancel")
+        self.telemetry_file = self.job_dir.joinpath("telemetry.jsonl")
+
+    def load(self) -> Dict[str, Any]:
+        return json.loads(self.job_file.read_text(encoding="utf-8"))
+
+    def update(self, **fields) -> Dict[str, Any]:
+        """Updates the job state, written atomically so readers never see a partial file."""
+        job = self.load() if self.job_file.exists() else {}
+        job.update(fields)
+        write_atomic(self.job_file, json.dumps(job))
+        return job
+
+    def write_partial(self, text: str):
+        write_atomic(self.partial_file, text)
+
+    def cancel_requested(self) -> bool:
+        return self.cancel_file.exists()
+
+
+def _generator_stats(generator, summary: TelemetrySummary) -> Dict[str, Any]:
+    return {
+        **summary.to_dict(),
+        "throttle": generator.rate_limiter.stats(),
+        "cache": generator.cache.stats() if generator.cache is not None else None,
+    }
+
+
+def _run_job(job_dir: str):
+    """Worker process entry point, runs the generator and writes its output and progress to the job files."""
+    # imported here, the parent process doesn't need the agent libraries to queue jobs
+    from aistorybooks.cache import ResponseCache
+    from aistorybooks.phidataa.classic_stories import PhiStoryBookGenerator, CHUNK_PARTIAL_EVENT
+    from aistorybooks.utils import PdfExtractionCache
+
+    files = _JobFiles(Path(job_dir))
+    job = files.load()
+    if files.cancel_requested():
+        files.update(state=CANCELLED, finished_at=time.time())
+        return
+    files.update(state=RUNNING, started_at=time.time(), pid=os.getpid())
+    try:
+        generator = PhiStoryBookGenerator(
+            **job["generator_kwargs"],
+            cache=ResponseCache() if job["use_cache"] else None,
+            extraction_cache=PdfExtractionCache() if job["use_cache"] else None,
+        )
+        errors = []
+        partial_text = ""
+        partial_written_at = 0.0
+        summary = TelemetrySummary()
+        telemetry_sink = TelemetrySinks(summary, JsonlTelemetrySink(files.telemetry_file))
+        for response in generator.run(pdf_file=Path(job["pdf_file"]), telemetry_sink=telemetry_sink,
+                                      **job["run_kwargs"]):
+            if files.cancel_requested():
+                files.update(state=CANCELLED, finished_at=time.time())
+                return
+            if response.event == CHUNK_PARTIAL_EVENT:
+                partial_text = "" if response.metrics.get("restarted") else partial_text + response.content
+                # pollers only look every second or so, don't rewrite the file for every few words
+                if time.monotonic() - partial_written_at > 0.5:
+                    files.write_partial(partial_text)
+                    partial_written_at = time.monotonic()
+                continue
+
+            partial_text = ""
+            files.write_partial("")
+            files.story.append(response.content)
+            if response.event == "RunFailed":
+                errors.append(response.content)
+                files.update(errors=errors, stats=_generator_stats(generator, summary))
+            else:
+                files.update(progress_percent=response.metrics['progress_percent'],
+                             progress_info=response.metrics['progress_info'],
+                             chunks=response.metrics['progress_current_index'],
+                             stats=_generator_stats(generator, summary))
+        files.update(state=COMPLETED, finished_at=time.time())
+    except Exception as e:
+        files.update(state=FAILED, error=f"{type(e).__name__}: {e}", finished_at=time.time())
+        raise
+
+
+class JobQueue:
+    """
+    Runs storybook conversions in a pool of worker processes, outside the process serving the UI.
+
+    Every job has its own directory under `root_dir` with its state, input and output, so the state
+    can be polled from any thread or rerun of the UI and outlives the submitting request. Each worker
+    process has its own rate limiter, keep `max_workers` within the provider quota.
+
+    Finished jobs are deleted `retention_seconds` after they finished, when the next job is submitted, or
+    right away with `delete`.
+    """
+
+    def __init__(self, root_dir: Optional[Path] = None, max_workers: int = 2, use_cache: bool = True,
+                 retention_seconds: Optional[float] = 24 * 60 * 60):
+        self.root_dir = Path(root_dir) if root_dir else Config.CACHE_DIR.joinpath("jobs")
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        self.use_cache = use_cache
+        self.retention_seconds = retention_seconds
+        self._executor = spawn_process_pool(max_workers)
+        self._futures: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def _files(self, job_id: str) -> _JobFiles:
+        files = _JobFiles(self.root_dir.joinpath(job_id))
+        if not files.job_file.exists():
+            raise KeyError(f"Unknown job: {job_id}")
+        return files
+
+    def submit(self, pdf_file: Path, generator_kwargs: Optional[Dict[str, Any]] = None,
+               run_kwargs: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Queues the conversion of a PDF and returns the job id. The PDF is copied into the job directory, the
+        keyword arguments of `PhiStoryBookGenerator` and its `run` method must be JSON serializable.
+        """
+        self.prune()
+        job_id = uuid.uuid4().hex
+        files = _JobFiles(self.root_dir.joinpath(job_id))
+        files.job_dir.mkdir(parents=True)
+        job_pdf = files.job_dir.joinpath(Path(pdf_file).name)
+        shutil.copyfile(pdf_file, job_pdf)
+        files.update(id=job_id, state=QUEUED, pdf_file=str(job_pdf), submitted_at=time.time(),
+                     use_cache=self.use_cache, generator_kwargs=generator_kwargs or {}, run_kwargs=run_kwargs or {},
+                     progress_percent=0, progress_info="Queued", chunks=0, errors=[])
+        with self._lock:
+            future = self._executor.submit(_run_job, str(files.job_dir))
+            self._futures[job_id] = future
+        future.add_done_callback(lambda done: self._on_done(job_id, done))
+        return job_id
+
+    def _on_done(self, job_id: str, future: Future):
+        # a worker that crashed or was killed can't record its own failure
+        files = _JobFiles(self.root_dir.joinpath(job_id))
+        if future.cancelled():
+            files.update(state=CANCELLED, finished_at=time.time())
+        elif future.exception() is not None:
+            if files.load()["state"] not in FINISHED_STATES:
+                files.update(state=FAILED, error=f"{type(future.exception()).__name__}: {future.exception()}",
+                             finished_at=time.time())
+
+    def status(self, job_id: str) -> Dict[str, Any]:
+        """Returns the job state and progress. Raises KeyError for unknown jobs."""
+        job = self._files(job_id).load()
+        with self._lock:
+            owned = job_id in self._futures
+        if job["state"] not in FINISHED_STATES and not owned:
+            job["state"] = INTERRUPTED
+        return job
+
+    def result(self, job_id: str) -> str:
+        """Returns the storybook markdown, of the chunks completed so far while the job is running."""
+        return self.story(job_id).read()
+
+    def story(self, job_id: str) -> StorybookBuffer:
+        """Returns the storybook buffer of the job, to read the chunks added since an earlier read."""
+        return self._files(job_id).story
+
+    def partial(self, job_id: str) -> str:
+        """Returns the streamed text of the chunk in progress."""
+        partial_file = self._files(job_id).partial_file
+        return partial_file.read_text(encoding="utf-8") if partial_file.exists() else ""
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancels a queued job or stops a running one after its current response, returns False if finished."""
+        if self.status(job_id)["state"] in FINISHED_STATES:
+            return False
+        files = self._files(job_id)
+        files.cancel_file.touch()
+        with self._lock:
+            future = self._futures.get(job_id)
+        if future is not None:
+            future.cancel()
+        return True
+
+    def delete(self, job_id: str) -> bool:
+        """Deletes a finished job with its files, returns False if the job is still queued or running."""
+        job = self.status(job_id)
+        if job["state"] not in FINISHED_STATES:
+            return False
+        with self._lock:
+            self._futures.pop(job_id, None)
+        shutil.rmtree(self.root_dir.joinpath(job_id), ignore_errors=True)
+        return True
+
+    def prune(self) -> int:
+        """Deletes the jobs finished more than `retention_seconds` ago, returns the number of deleted jobs."""
+        if self.retention_seconds is None:
+            return 0
+        deleted = 0
+        for job_file in self.root_dir.glob(f"*/{_JobFiles.JOB_FILE}"):
+            job_id = job_file.parent.name
+            try:
+                job = self.status(job_id)
+            except (KeyError, ValueError):
+                # removed by another process, or not written completely yet
+                continue
+            # interrupted jobs of an earlier process never finished, they expire from their submission
+            finished_at = job.get("finished_at") or job.get("submitted_at") or 0
+            if job["state"] in FINISHED_STATES and time.time() - finished_at > self.retention_seconds:
+                deleted += self.delete(job_id)
+        return deleted
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
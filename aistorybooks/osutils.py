@@ -0,0 +1,29 @@
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+
+def write_atomic(file: Path, text: str):
+    """
+    Writes `text` to a temporary file next to `file` and moves it into place, so readers see either the old
+    or the new content, never a partial file.
+    """
+    file = Path(file)
+    fd, temp_file = tempfile.mkstemp(prefix=f".{file.name}", dir=file.parent)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(temp_file, file)
+    except BaseException:
+        Path(temp_file).unlink(missing_ok=True)
+        raise
+
+
+def spawn_process_pool(max_workers: int) -> ProcessPoolExecutor:
+    """
+    Process pool starting its workers with spawn. The calling process may run threads, like the web server or
+    the chunk pipelines, which don't mix well with fork.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
@@ -1,25 +1,125 @@
+import asyncio
+import contextlib
 import httpx
-from openai._base_client import SyncHttpxClientWrapper
+import itertools
+import queue
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from llama_index.core.schema import Document
+from openai import AsyncOpenAI
 from pathlib import Path
 from phi.agent import Agent as PhiAgent
-from phi.model.google.gemini import Gemini
+from phi.model.base import Model
+from phi.model.openai import OpenAIChat
 from phi.model.openai.like import OpenAILike
 from phi.utils.log import logger as PhiLogger
 from phi.workflow import RunResponse, RunEvent
-from typing import Optional, Union, Iterator
+from typing import (Optional, Union, Iterator, Iterable, Callable, Tuple, TypeVar, AsyncIterator, List, Dict, Any,
+                    Generator)
 
+from aistorybooks.cache import ResponseCache
+from aistorybooks.checkpoint import RunCheckpoint
 from aistorybooks.config import Config
-from aistorybooks.utils import PdfUtil
+from aistorybooks.httpclients import HttpClients
+from aistorybooks.ratelimit import RateLimiter
+from aistorybooks.telemetry import AgentTelemetry, ChunkTelemetry, TelemetrySink
+from aistorybooks.utils import PdfUtil, PdfExtractionCache, DocumentChunk, CachedPages
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# event of the partial translator output yielded by `PhiStoryBookGenerator.run(stream=True)`
+CHUNK_PARTIAL_EVENT = "ChunkPartial"
+
+
+def _run_ordered(func: Callable[[T], R], items: Iterable[T], max_workers: int = 1) -> Iterator[R]:
+    """
+    Applies `func` to every item on a bounded thread pool and yields the results in input order.
+
+    At most `2 * max_workers` items are in flight, so slow items at the head don't let the
+    backlog grow unbounded. With `max_workers <= 1` items are processed inline.
+    """
+    if max_workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="story_chunk")
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+_PIPELINE_DONE = object()
+
+
+def _run_pipelined(first_stage: Callable[[T], R], second_stage: Callable[[R], T], items: Iterable[T],
+                   queue_size: int = 2, max_workers: int = 1) -> Iterator:
+    """
+    Runs `first_stage` in a background thread and `second_stage` in the calling thread, connected by a
+    bounded queue, so the stages overlap while each keeps its own concurrency. Results keep input order.
+    """
+    stage_queue = queue.Queue(maxsize=max(1, queue_size))
+    stopped = threading.Event()
+
+    def put(entry) -> bool:
+        while not stopped.is_set():
+            try:
+                stage_queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for result in _run_ordered(first_stage, items, max_workers=max_workers):
+                if not put((result, None)):
+                    return
+        except BaseException as e:
+            put((None, e))
+        finally:
+            put(_PIPELINE_DONE)
+
+    producer = threading.Thread(target=produce, name="story_pipeline", daemon=True)
+    producer.start()
+    try:
+        while True:
+            entry = stage_queue.get()
+            if entry is _PIPELINE_DONE:
+                break
+            result, error = entry
+            if error is not None:
+                raise error
+            yield second_stage(result)
+    finally:
+        stopped.set()
+        producer.join()
 
 
 class OpenAILikeNoVerifySSL(OpenAILike):
 
     def __init__(self, base_url: Optional[Union[str, httpx.URL]] = None, *args, **kwargs):
-        http_client = SyncHttpxClientWrapper(
-            base_url=base_url,
-            verify=False
-        )
-        super().__init__(http_client=http_client, base_url=base_url, *args, **kwargs)
+        # rate limited calls are retried by the RateLimiter, retries within the sdk would hide the 429s from it
+        kwargs.setdefault("max_retries", 0)
+        # all instances share one connection pool
+        super().__init__(http_client=HttpClients.httpx_client(verify=False), base_url=base_url, *args, **kwargs)
+
+    def get_async_client(self) -> AsyncOpenAI:
+        if self.async_client:
+            return self.async_client
+        # the shared sync client can't serve async calls, they use the async pool of the running event loop
+        return AsyncOpenAI(**self.get_client_params(), http_client=HttpClients.async_httpx_client(verify=False))
 
 
 class PhiStoryBookGenerator:
@@ -30,85 +130,828 @@ class PhiStoryBookGenerator:
             level: str = "A2 Beginner",
             summary_size: str = "approximately 100 sentences and approximately 800 hundred words",
             writing_style: str = "Funny",
+            cache: Optional[ResponseCache] = None,
+            summary_cache: Optional[ResponseCache] = None,
+            shared_summaries: bool = False,
+            extraction_cache: Optional[PdfExtractionCache] = None,
+            rate_limiter: Optional[RateLimiter] = None,
+            model: Optional[Model] = None,
             **kwargs
     ):
+        """
+        Args:
+            cache: Optional response cache, agent calls with the same model, prompt and input are served from it.
+            summary_cache: Optional cache of the author stage only, defaults to `cache`.
+            shared_summaries: Leaves the level out of the author prompt, so it only depends on `summary_size` and
+                `writing_style`. With a `summary_cache`, runs changing just the language or level then reuse the
+                summaries and only call the translator. `run_targets` always writes shared summaries.
+            extraction_cache: Optional cache of the PDF to markdown extraction, keyed by the PDF content.
+            rate_limiter: Limits and retries the agent calls, defaults to the shared limiter of the model.
+            model: Model of the agents, defaults to Gemini.
+        """
         self.language = language
         self.level = level
         self.summary_size = summary_size
         self.writing_style = writing_style
-        self.model = Gemini(
+        self.cache = cache
+        self.summary_cache = summary_cache if summary_cache is not None else cache
+        self.shared_summaries = shared_summaries
+        self.extraction_cache = extraction_cache
+        self.model = model or self._default_model()
+        if isinstance(self.model, OpenAIChat) and self.model.max_retries is None:
+            # the rate limiter retries 429s itself, it has to see them to lower the request rate
+            self.model.max_retries = 0
+        self.rate_limiter = rate_limiter or RateLimiter.for_model(self.model.id)
+
+        self.author_agent = self._create_author_agent()
+        self.translator_agent = self._create_translator_agent()
+        # phi agents keep per-run state, worker threads get their own agent instances
+        self._thread_local = threading.local()
+        self._thread_local.agents = (self.author_agent, self.translator_agent)
+        # agents of the async api, one pair per concurrently processed chunk
+        self._agent_pool: List[Tuple[PhiAgent, PhiAgent]] = []
+
+    @staticmethod
+    def _default_model() -> Model:
+        # imported here, the google sdk is slow to import and not needed when a model is given
+        from phi.model.google.gemini import Gemini
+
+        return Gemini(
             id=Config.GEMINI_MODEL_NAME,
             api_key=Config.GEMINI_API_KEY
         )
 
-        self.author_agent = PhiAgent(
+    def _create_author_agent(self, shared: Optional[bool] = None) -> PhiAgent:
+        shared = self.shared_summaries if shared is None else shared
+        learners = "language learners" if shared else f"{self.level} language learners"
+        return PhiAgent(
             model=self.model,
             description="Expert author rewriting novels to a shortened stories.",
             task=(
                 f"Rewrite given the novel text to {self.summary_size} a story, "
                 f"rewrite it in a {self.writing_style} style. "
-                f"Target {self.level} language learners. Repeat key words. Maintain narrative flow."
+                f"Target {learners}. Repeat key words. Maintain narrative flow."
                 f"This is a first section of the big novel. Next sections will follow."
             ),
             markdown=True,
             debug_mode=True,
         )
 
-        self.translator_agent = PhiAgent(
+    def _create_translator_agent(self, language: Optional[str] = None, level: Optional[str] = None) -> PhiAgent:
+        language = language or self.language
+        level = level or self.level
+        return PhiAgent(
             model=self.model,
-            description=f"Expert English to {self.language} translator.",
+            description=f"Expert English to {language} translator.",
             task=(
-                f"Translate Given English text to {self.language} for {self.level} level language learners. "
+                f"Translate Given English text to {language} for {level} level language learners. "
                 f"Repeat key words. Ensure natural story flow."
             ),
             markdown=True,
             debug_mode=True,
         )
 
+    def _local_agents(self) -> Tuple[PhiAgent, PhiAgent]:
+        """Returns the (author, translator) agents owned by the calling thread."""
+        agents = getattr(self._thread_local, "agents", None)
+        if agents is None:
+            agents = (self._create_author_agent(), self._create_translator_agent())
+            self._thread_local.agents = agents
+        return agents
+
+    def _local_shared_author(self) -> PhiAgent:
+        """Returns the author agent writing summaries shared by all targets, owned by the calling thread."""
+        if self.shared_summaries:
+            return self._local_agents()[0]
+        agent = getattr(self._thread_local, "shared_author", None)
+        if agent is None:
+            agent = self._thread_local.shared_author = self._create_author_agent(shared=True)
+        return agent
+
+    def _local_translator(self, language: str, level: str) -> PhiAgent:
+        """Returns the translator agent of the (language, level) target owned by the calling thread."""
+        translators = getattr(self._thread_local, "translators", None)
+        if translators is None:
+            translators = self._thread_local.translators = {}
+        agent = translators.get((language, level))
+        if agent is None:
+            agent = translators[(language, level)] = self._create_translator_agent(language, level)
+        return agent
+
     def return_if_response_none(self, response: RunResponse):
         if response is None:
             yield RunResponse(event=RunEvent.workflow_completed, content=f"Sorry, received empty result")
 
-    # @TODO add tenacity and retry api call "rate limit exceptions"!
-    def _run_chunk(self, content: str, start_page, end_page) -> RunResponse:
+    def _call_agent(self, agent: PhiAgent, message: str, telemetry: Optional[AgentTelemetry] = None) -> RunResponse:
+        """Runs the agent within the rate limits, retrying rate limited calls."""
+        attempts = 0
+
+        def run(text: str) -> RunResponse:
+            nonlocal attempts
+            attempts += 1
+            return agent.run(text)
+
+        started_at = time.perf_counter()
+        response: RunResponse = self.rate_limiter.call(run, message, tokens=PdfUtil.estimate_tokens(message))
+        self._record_usage(response)
+        if telemetry is not None:
+            telemetry.add_call(time.perf_counter() - started_at, attempts, response.metrics if response else None)
+        return response
+
+    def _model_supports_async(self) -> bool:
+        # models without async support, like Gemini, raise NotImplementedError from the Model base class
+        return type(self.model).aresponse is not Model.aresponse
+
+    async def _acall_agent(self, agent: PhiAgent, message: str,
+                           telemetry: Optional[AgentTelemetry] = None) -> RunResponse:
+        attempts = 0
+
+        async def run(text: str) -> RunResponse:
+            nonlocal attempts
+            attempts += 1
+            if self._model_supports_async():
+                return await agent.arun(text)
+            return await asyncio.to_thread(agent.run, text)
+
+        started_at = time.perf_counter()
+        response: RunResponse = await self.rate_limiter.acall(run, message, tokens=PdfUtil.estimate_tokens(message))
+        self._record_usage(response)
+        if telemetry is not None:
+            telemetry.add_call(time.perf_counter() - started_at, attempts, response.metrics if response else None)
+        return response
+
+    def _record_usage(self, response: Optional[RunResponse]):
+        output_tokens = (response.metrics or {}).get("output_tokens", 0) if response is not None else 0
+        self.rate_limiter.record_usage(sum(output_tokens) if isinstance(output_tokens, list) else output_tokens)
+
+    def _cache_key(self, agent: PhiAgent, message: str) -> str:
+        return ResponseCache.make_key(self.model.id, agent.description, agent.task, ResponseCache.hash_text(message))
+
+    def _run_agent(self, agent: PhiAgent, message: str, telemetry: Optional[AgentTelemetry] = None,
+                   cache: Optional[ResponseCache] = None) -> RunResponse:
+        """Runs the agent, going through `cache`, by default the response cache, when one is configured."""
+        cache = cache or self.cache
+        if cache is None:
+            return self._call_agent(agent, message, telemetry)
+
+        started_at = time.perf_counter()
+        key = self._cache_key(agent, message)
+        content = cache.get(key)
+        if content is not None:
+            if telemetry is not None:
+                telemetry.add_call(time.perf_counter() - started_at, metrics={"cache_hit": True})
+            return RunResponse(content=content, metrics={"cache_hit": True})
+
+        response = self._call_agent(agent, message, telemetry)
+        if response is not None and response.content is not None:
+            cache.put(key, response.content)
+        return response
+
+    async def _arun_agent(self, agent: PhiAgent, message: str, telemetry: Optional[AgentTelemetry] = None,
+                          cache: Optional[ResponseCache] = None) -> RunResponse:
+        cache = cache or self.cache
+        if cache is None:
+            return await self._acall_agent(agent, message, telemetry)
+
+        started_at = time.perf_counter()
+        key = self._cache_key(agent, message)
+        content = await asyncio.to_thread(cache.get, key)
+        if content is not None:
+            if telemetry is not None:
+                telemetry.add_call(time.perf_counter() - started_at, metrics={"cache_hit": True})
+            return RunResponse(content=content, metrics={"cache_hit": True})
+
+        response = await self._acall_agent(agent, message, telemetry)
+        if response is not None and response.content is not None:
+            await asyncio.to_thread(cache.put, key, response.content)
+        return response
+
+    def _stream_agent(self, agent: PhiAgent, message: str, metrics: dict,
+                      telemetry: Optional[AgentTelemetry] = None) -> Iterator[RunResponse]:
+        """
+        Streams the agent output as partial events, followed by the complete response. A stream interrupted by
+        a rate limit error is restarted, announced by an empty partial event with the `restarted` metric.
+        """
+        started_at = time.perf_counter()
+        key = None
+        if self.cache is not None:
+            key = self._cache_key(agent, message)
+            content = self.cache.get(key)
+            if content is not None:
+                if telemetry is not None:
+                    telemetry.add_call(time.perf_counter() - started_at, metrics={"cache_hit": True})
+                yield RunResponse(content=content, metrics={"cache_hit": True})
+                return
+
+        attempts = 0
+        for attempt in self.rate_limiter.retrying():
+            with attempt:
+                attempts = attempt.retry_state.attempt_number
+                if attempt.retry_state.attempt_number > 1:
+                    yield RunResponse(event=CHUNK_PARTIAL_EVENT, content="", metrics={**metrics, "restarted": True})
+                self.rate_limiter.acquire(PdfUtil.estimate_tokens(message))
+                parts = []
+                for delta in agent.run(message, stream=True):
+                    if delta is not None and delta.content:
+                        parts.append(delta.content)
+                        yield RunResponse(event=CHUNK_PARTIAL_EVENT, content=delta.content, metrics=dict(metrics))
+                self.rate_limiter.record_success()
+
+        run_response = getattr(agent, "run_response", None)
+        response = RunResponse(content="".join(parts) or None,
+                               metrics=dict(getattr(run_response, "metrics", None) or {}))
+        self._record_usage(response)
+        if telemetry is not None:
+            telemetry.add_call(time.perf_counter() - started_at, attempts, response.metrics)
+        if key is not None and response.content is not None:
+            self.cache.put(key, response.content)
+        yield response
+
+    @staticmethod
+    def _summary_response(summary: Optional[RunResponse], start_page, end_page) -> RunResponse:
+        if summary is None or summary.content is None:
+            return RunResponse(event="RunFailed",
+                               content=f"Failed to generate summary for pages {start_page}-{end_page}")
+        return summary
+
+    @staticmethod
+    def _translation_response(translated: Optional[RunResponse], start_page, end_page) -> RunResponse:
+        if translated is None or translated.content is None:
+            return RunResponse(event="RunFailed",
+                               content=f"Failed to translate summary for pages {start_page}-{end_page}")
+        return translated
+
+    def _summarize_chunk(self, content: str, start_page, end_page, telemetry: Optional[AgentTelemetry] = None,
+                         author_agent: Optional[PhiAgent] = None) -> RunResponse:
+        author_agent = author_agent or self._local_agents()[0]
         try:
-            summary: RunResponse = self.author_agent.run(content)
-            if summary is None or summary.content is None:
-                return RunResponse(event="RunFailed",
-                                   content=f"Failed to generate summary for pages {start_page}-{end_page}")
-
-            translated: RunResponse = self.translator_agent.run(summary.content)
-            if translated is None or translated.content is None:
-                return RunResponse(event="RunFailed",
-                                   content=f"Failed to translate summary for pages {start_page}-{end_page}")
-            return translated
+            return self._summary_response(self._run_agent(author_agent, content, telemetry, cache=self.summary_cache),
+                                          start_page, end_page)
         except Exception as e:
             return RunResponse(event="RunFailed", content=f"Error processing pages {start_page}-{end_page}: {e}")
 
-    def run(self, pdf_file: Path, chunk_size=10, padding=1, skip_first_n_pages=0) -> Iterator[RunResponse]:
-        # final = pdf_file.parent.joinpath(f"{pdf_file.stem}.md")
-        data = PdfUtil.process_pdf_file(pdf_file)
-        chunks = PdfUtil.split_document_into_chunks(
-            data=data,
+    def _translate_summary(self, summary: RunResponse, start_page, end_page,
+                           telemetry: Optional[AgentTelemetry] = None,
+                           target: Optional[Tuple[str, str]] = None) -> RunResponse:
+        """Translates the summary to the language and level of the generator, or of the `target`."""
+        if summary.event == "RunFailed":
+            return summary
+        translator_agent = self._local_translator(*target) if target else self._local_agents()[1]
+        try:
+            return self._translation_response(self._run_agent(translator_agent, summary.content, telemetry),
+                                              start_page, end_page)
+        except Exception as e:
+            return RunResponse(event="RunFailed", content=f"Error processing pages {start_page}-{end_page}: {e}")
+
+    def _stream_translation(self, summary: RunResponse, start_page, end_page, index,
+                            telemetry: Optional[AgentTelemetry] = None) -> Iterator[RunResponse]:
+        """Streaming version of `_translate_summary`, the complete translation is the last response."""
+        if summary.event == "RunFailed":
+            yield summary
+            return
+        _, translator_agent = self._local_agents()
+        try:
+            for response in self._stream_agent(translator_agent, summary.content,
+                                               metrics={"progress_current_index": index + 1}, telemetry=telemetry):
+                if response.event == CHUNK_PARTIAL_EVENT:
+                    yield response
+                else:
+                    yield self._translation_response(response, start_page, end_page)
+        except Exception as e:
+            yield RunResponse(event="RunFailed", content=f"Error processing pages {start_page}-{end_page}: {e}")
+
+    BATCH_MARKER = "<<<SECTION {number}>>>"
+
+    @classmethod
+    def _split_batch(cls, content: str, count: int) -> Optional[List[str]]:
+        """Splits a batched translation at the section markers, None when markers were lost or reordered."""
+        pattern = re.escape(cls.BATCH_MARKER).replace(re.escape("{number}"), r"(\d+)")
+        parts = re.split(rf"^\s*{pattern}\s*$", content, flags=re.MULTILINE)
+        numbers = parts[1::2]
+        if numbers != [str(number) for number in range(1, count + 1)]:
+            return None
+        sections = [section.strip() for section in parts[2::2]]
+        return sections if all(sections) else None
+
+    def _translate_batch(self, batch: List[Tuple[int, list, RunResponse]],
+                         telemetry: Optional[Dict[int, ChunkTelemetry]] = None) -> List[Tuple[int, list, RunResponse]]:
+        """
+        Translates several summaries with one translator request, separated by section markers. Falls back to
+        one request per summary when the response can't be split back into the sections.
+        """
+        telemetry = telemetry or {}
+        for index, _, _ in batch:
+            if index in telemetry:
+                telemetry[index].start_stage()
+
+        def translator_telemetry(index) -> Optional[AgentTelemetry]:
+            return telemetry[index].translator if index in telemetry else None
+
+        if len(batch) == 1:
+            index, chunk, summary = batch[0]
+            return [(index, chunk, self._translate_summary(summary, *self._chunk_pages(chunk),
+                                                           telemetry=translator_telemetry(index)))]
+
+        start_page, end_page = self._chunk_pages(batch[0][1])[0], self._chunk_pages(batch[-1][1])[1]
+        PhiLogger.info(f"Translating Pages: {start_page}-{end_page} in one batch of {len(batch)} sections")
+        _, translator_agent = self._local_agents()
+        message = (
+                "Translate each section below. Keep every section marker line exactly as it is, "
+                "in the same order, and translate only the text between the markers.\n\n"
+                + "\n\n".join(f"{self.BATCH_MARKER.format(number=number)}\n{summary.content}"
+                               for number, (_, _, summary) in enumerate(batch, start=1))
+        )
+        sections = None
+        batch_telemetry = AgentTelemetry()
+        started_at = time.perf_counter()
+        try:
+            translated = self._run_agent(translator_agent, message, batch_telemetry)
+            if translated is not None and translated.content is not None:
+                sections = self._split_batch(translated.content, len(batch))
+        except Exception as e:
+            PhiLogger.warning(f"Batched translation of pages {start_page}-{end_page} failed: {e}")
+            if batch_telemetry.calls == 0:
+                batch_telemetry.add_call(time.perf_counter() - started_at)
+        # the batch request is shared equally by its chunks and counted once, also when it failed
+        for position, (index, _, _) in enumerate(batch):
+            if index in telemetry:
+                telemetry[index].translator.add_share(batch_telemetry, share=1 / len(batch), count=position == 0)
+        if sections is None:
+            PhiLogger.warning(f"Batched translation of pages {start_page}-{end_page} couldn't be split, "
+                              f"translating the sections one by one")
+            return [(index, chunk, self._translate_summary(summary, *self._chunk_pages(chunk),
+                                                           telemetry=translator_telemetry(index)))
+                    for index, chunk, summary in batch]
+
+        metrics = {**(translated.metrics or {}), "translation_batch_size": len(batch)}
+        return [(index, chunk, RunResponse(content=section, metrics=dict(metrics)))
+                for (index, chunk, _), section in zip(batch, sections)]
+
+    def _iter_batched_translations(self, summarized: Iterable[Tuple[int, list, RunResponse]], batch_tokens: int,
+                                   telemetry: Optional[Dict[int, ChunkTelemetry]] = None
+                                   ) -> Iterator[Tuple[int, list, RunResponse]]:
+        """Groups consecutive summaries up to `batch_tokens` and translates each group with one request."""
+        batch = []
+        tokens = 0
+        for index, chunk, summary in summarized:
+            if summary.event == "RunFailed" or (summary.metrics or {}).get("resumed"):
+                if batch:
+                    yield from self._translate_batch(batch, telemetry)
+                batch, tokens = [], 0
+                yield index, chunk, summary
+                continue
+            summary_tokens = PdfUtil.estimate_tokens(summary.content)
+            if batch and tokens + summary_tokens > batch_tokens:
+                yield from self._translate_batch(batch, telemetry)
+                batch, tokens = [], 0
+            batch.append((index, chunk, summary))
+            tokens += summary_tokens
+        if batch:
+            yield from self._translate_batch(batch, telemetry)
+
+    def _run_chunk(self, content: str, start_page, end_page, telemetry: Optional[ChunkTelemetry] = None) -> RunResponse:
+        summary = self._summarize_chunk(content=content, start_page=start_page, end_page=end_page,
+                                        telemetry=telemetry.author if telemetry else None)
+        return self._translate_summary(summary=summary, start_page=start_page, end_page=end_page,
+                                       telemetry=telemetry.translator if telemetry else None)
+
+    async def _arun_chunk(self, content: str, start_page, end_page,
+                          telemetry: Optional[ChunkTelemetry] = None) -> RunResponse:
+        """Async version of `_run_chunk`, the agents are taken from a pool so concurrent chunks don't share them."""
+        agents = self._agent_pool.pop() if self._agent_pool else (self._create_author_agent(),
+                                                                   self._create_translator_agent())
+        author_agent, translator_agent = agents
+        try:
+            summary = self._summary_response(
+                await self._arun_agent(author_agent, content, telemetry.author if telemetry else None,
+                                       cache=self.summary_cache),
+                start_page, end_page
+            )
+            if summary.event == "RunFailed":
+                return summary
+            return self._translation_response(
+                await self._arun_agent(translator_agent, summary.content, telemetry.translator if telemetry else None),
+                start_page, end_page
+            )
+        except Exception as e:
+            return RunResponse(event="RunFailed", content=f"Error processing pages {start_page}-{end_page}: {e}")
+        finally:
+            self._agent_pool.append(agents)
+
+    @staticmethod
+    def _chunk_pages(chunk) -> Tuple[int, int]:
+        return chunk[0].extra_info.get('page'), chunk[-1].extra_info.get('page')
+
+    @staticmethod
+    def _chunk_text(chunk) -> str:
+        if isinstance(chunk, DocumentChunk):
+            return chunk.text
+        return "\n\n".join([doc.text for doc in chunk])
+
+    def _open_pages(self, pdf_file: Path, extraction_workers) -> Iterable[Document]:
+        # pages are converted lazily, the first chunks are processed while the rest of the PDF is being parsed
+        return PdfUtil.iter_process_pdf_file(pdf_file, cache=self.extraction_cache, workers=extraction_workers)
+
+    @staticmethod
+    def _close_pages(pages: Iterable[Document]):
+        """Releases the file of cached pages, or stops the extraction processes of pages still being parsed."""
+        if isinstance(pages, (CachedPages, Generator)):
+            pages.close()
+
+    def _iter_chunks(self, pages: Iterable[Document], chunk_size, padding, skip_first_n_pages,
+                     max_chunk_tokens, overlap_tokens) -> Iterator:
+        if max_chunk_tokens:
+            return PdfUtil.iter_token_chunks(
+                pages=pages,
+                max_tokens=max_chunk_tokens,
+                overlap_tokens=overlap_tokens,
+                skip_first_n_pages=skip_first_n_pages
+            )
+        return PdfUtil.iter_document_chunks(
+            pages=pages,
             chunk_size=chunk_size,
             padding=padding,
             skip_first_n_pages=skip_first_n_pages
         )
 
-        total_chunks = len(chunks)
-        for index, chunk in enumerate(chunks):
-            start_page = chunk[0].extra_info.get('page')
-            end_page = chunk[-1].extra_info.get('page')
-            total_pages = chunk[-1].extra_info.get('total_pages')
+    def _iter_indexed_chunks(self, chunks: Iterator,
+                             telemetry: Dict[int, ChunkTelemetry]) -> Iterator[Tuple[int, list]]:
+        """Numbers the chunks and starts the telemetry of each, with the time spent extracting it."""
+        for index in itertools.count():
+            started_at = time.perf_counter()
+            chunk = next(chunks, None)
+            if chunk is None:
+                return
+            start_page, end_page = self._chunk_pages(chunk)
+            telemetry[index] = ChunkTelemetry(index=index, start_page=start_page, end_page=end_page,
+                                              model=self.model.id, created_at=started_at,
+                                              extraction_seconds=time.perf_counter() - started_at)
+            yield index, chunk
+
+    def _create_checkpoint(self, pdf_file: Path, checkpoint_dir: Optional[Path], resume,
+                           language: Optional[str] = None, level: Optional[str] = None,
+                           **params) -> Optional[RunCheckpoint]:
+        if checkpoint_dir is None:
+            return None
+        checkpoint = RunCheckpoint.for_run(
+            pdf_hash=PdfUtil.file_hash(pdf_file),
+            params=dict(model=self.model.id, language=language or self.language, level=level or self.level,
+                        summary_size=self.summary_size, writing_style=self.writing_style, **params),
+            root_dir=checkpoint_dir
+        )
+        if not resume:
+            checkpoint.clear()
+        return checkpoint
+
+    def _restore_chunk(self, checkpoint: Optional[RunCheckpoint], index, chunk) -> Optional[RunResponse]:
+        if checkpoint is None:
+            return None
+        content = checkpoint.load(index, *self._chunk_pages(chunk))
+        if content is None:
+            return None
+        PhiLogger.info(f"Restored Pages: {'-'.join(map(str, self._chunk_pages(chunk)))} from checkpoint")
+        return RunResponse(content=content, metrics={"resumed": True})
+
+    def _complete_response(self, index, chunk, response: RunResponse, checkpoint: Optional[RunCheckpoint],
+                           chunk_size, skip_first_n_pages, max_chunk_tokens, telemetry: Optional[ChunkTelemetry] = None,
+                           telemetry_sink: Optional[TelemetrySink] = None) -> RunResponse:
+        """Saves the chunk result to the checkpoint and adds the progress and telemetry metrics."""
+        if checkpoint is not None and response.event != "RunFailed" and not (response.metrics or {}).get("resumed"):
+            checkpoint.save(index, *self._chunk_pages(chunk), content=response.content)
+
+        end_page = chunk[-1].extra_info.get('page')
+        total_pages = chunk[-1].extra_info.get('total_pages')
+        if max_chunk_tokens:
+            # chunk count isn't known upfront, estimate it from the pages processed so far
+            done = max(1, end_page - skip_first_n_pages) / max(1, total_pages - skip_first_n_pages)
+            total_chunks = max(index + 1, round((index + 1) / done))
+            progress_percent = int(done * 100)
+        else:
+            total_chunks = len(range(skip_first_n_pages, total_pages, chunk_size))
+            progress_percent = int(((index + 1) / total_chunks) * 100)
+
+        if response.event != "RunFailed":
+            response.metrics[
+                'progress_info'] = f"Processed Pages: {skip_first_n_pages}-{end_page} of {total_pages}"
+            response.metrics['progress_total'] = total_chunks
+            response.metrics['progress_current_index'] = index + 1
+            response.metrics['progress_percent'] = progress_percent
+
+        if telemetry is not None:
+            telemetry.complete(failed=response.event == "RunFailed",
+                               resumed=bool((response.metrics or {}).get("resumed")))
+            response.metrics = {**(response.metrics or {}), "telemetry": telemetry.to_dict()}
+            if telemetry_sink is not None:
+                telemetry_sink.record(telemetry)
+        return response
+
+    @staticmethod
+    def _finish_checkpoint(checkpoint: Optional[RunCheckpoint], failed: bool):
+        # a run completed without failures has nothing left to resume
+        if checkpoint is not None and not failed:
+            checkpoint.delete()
+
+    def run(self, pdf_file: Path, chunk_size=10, padding=1, skip_first_n_pages=0, max_workers=1,
+            pipelined=False, queue_size=2, extraction_workers=1, max_chunk_tokens: Optional[int] = None,
+            overlap_tokens=0, checkpoint_dir: Optional[Path] = None, resume=False,
+            translation_batch_tokens: Optional[int] = None, stream=False,
+            telemetry_sink: Optional[TelemetrySink] = None) -> Iterator[RunResponse]:
+        """
+        Converts the PDF to a storybook chunk by chunk.
+
+        Args:
+            max_workers: Number of chunks processed concurrently. Responses are always yielded in page order.
+                In pipelined mode it applies to the author stage only.
+            pipelined: Runs the author stage of the next chunks while the current chunk is being translated.
+            queue_size: Number of finished summaries allowed to wait for the translator in pipelined mode.
+            extraction_workers: Number of processes converting PDF pages to markdown.
+            max_chunk_tokens: Packs pages into chunks of up to this many (estimated) tokens instead of
+                `chunk_size` pages, `overlap_tokens` then replaces `padding`.
+            overlap_tokens: Tokens of the previous chunk repeated at the start of the next one for context.
+            checkpoint_dir: Saves every completed chunk under this directory, in a run directory keyed by the
+                PDF content and the generation parameters. The run directory is deleted once the run completes
+                without failed chunks.
+            resume: Returns the chunks completed by an earlier run from the checkpoint instead of processing
+                them again, failed and missing chunks are processed.
+            translation_batch_tokens: Translates consecutive summaries together in one request, up to this
+                many (estimated) tokens. Saves requests when the requests per minute limit is the bottleneck.
+            stream: Yields the translator output while it is generated, as `CHUNK_PARTIAL_EVENT` responses
+                carrying the new text, followed by the usual response of the completed chunk. The author stage
+                runs ahead in the background like in pipelined mode. Cached and resumed chunks are yielded
+                complete only. Overrides `pipelined`: the translator streams one chunk at a time and
+                `max_workers` applies to the author stage only.
+            telemetry_sink: Receives the telemetry of every completed chunk, which is also added to the chunk
+                response as `metrics["telemetry"]`, see `aistorybooks.telemetry.ChunkTelemetry`.
+        """
+        if stream and translation_batch_tokens:
+            raise ValueError("stream can't be combined with translation_batch_tokens")
+        # final = pdf_file.parent.joinpath(f"{pdf_file.stem}.md")
+        checkpoint = self._create_checkpoint(pdf_file, checkpoint_dir, resume, chunk_size=chunk_size,
+                                             padding=padding, skip_first_n_pages=skip_first_n_pages,
+                                             max_chunk_tokens=max_chunk_tokens, overlap_tokens=overlap_tokens)
+        restore_from = checkpoint if resume else None
+        telemetry: Dict[int, ChunkTelemetry] = {}
+        failed = False
+
+        def process_chunk(indexed_chunk) -> Tuple[int, list, RunResponse]:
+            index, chunk = indexed_chunk
+            restored = self._restore_chunk(restore_from, index, chunk)
+            if restored is not None:
+                return index, chunk, restored
+            start_page, end_page = self._chunk_pages(chunk)
             PhiLogger.info(f"Processing Pages: {start_page}-{end_page}")
-            chunk_str = "\n\n".join([doc.text for doc in chunk])
+            telemetry[index].start_stage()
+            response = self._run_chunk(content=self._chunk_text(chunk), start_page=start_page, end_page=end_page,
+                                       telemetry=telemetry[index])
+            telemetry[index].end_stage()
+            return index, chunk, response
+
+        def summarize_chunk(indexed_chunk) -> Tuple[int, list, RunResponse]:
+            index, chunk = indexed_chunk
+            restored = self._restore_chunk(restore_from, index, chunk)
+            if restored is not None:
+                return index, chunk, restored
+            start_page, end_page = self._chunk_pages(chunk)
+            PhiLogger.info(f"Summarizing Pages: {start_page}-{end_page}")
+            telemetry[index].start_stage()
+            summary = self._summarize_chunk(content=self._chunk_text(chunk), start_page=start_page,
+                                            end_page=end_page, telemetry=telemetry[index].author)
+            telemetry[index].end_stage()
+            return index, chunk, summary
+
+        def translate_summary(summarized: Tuple[int, list, RunResponse]) -> Tuple[int, list, RunResponse]:
+            index, chunk, summary = summarized
+            if (summary.metrics or {}).get("resumed"):
+                return summarized
+            start_page, end_page = self._chunk_pages(chunk)
+            PhiLogger.info(f"Translating Pages: {start_page}-{end_page}")
+            telemetry[index].start_stage()
+            translated = self._translate_summary(summary=summary, start_page=start_page, end_page=end_page,
+                                                 telemetry=telemetry[index].translator)
+            telemetry[index].end_stage()
+            return index, chunk, translated
+
+        def complete_response(index, chunk, response: RunResponse) -> RunResponse:
+            nonlocal failed
+            failed = failed or response.event == "RunFailed"
+            return self._complete_response(index, chunk, response, checkpoint, chunk_size=chunk_size,
+                                           skip_first_n_pages=skip_first_n_pages, max_chunk_tokens=max_chunk_tokens,
+                                           telemetry=telemetry.pop(index, None), telemetry_sink=telemetry_sink)
+
+        pages = self._open_pages(pdf_file, extraction_workers)
+        with contextlib.ExitStack() as stack:
+            # exits in reverse order, the pipelines are stopped before the pages they read are closed
+            stack.callback(self._close_pages, pages)
+            chunks = self._iter_chunks(pages, chunk_size=chunk_size, padding=padding,
+                                       skip_first_n_pages=skip_first_n_pages, max_chunk_tokens=max_chunk_tokens,
+                                       overlap_tokens=overlap_tokens)
+            indexed_chunks = self._iter_indexed_chunks(chunks, telemetry)
+            if stream:
+                summaries = stack.enter_context(contextlib.closing(
+                    _run_pipelined(summarize_chunk, lambda summarized: summarized, indexed_chunks,
+                                   queue_size=queue_size, max_workers=max_workers)))
+                for index, chunk, response in summaries:
+                    if not (response.metrics or {}).get("resumed"):
+                        start_page, end_page = self._chunk_pages(chunk)
+                        PhiLogger.info(f"Translating Pages: {start_page}-{end_page}")
+                        telemetry[index].start_stage()
+                        for event in self._stream_translation(response, start_page, end_page, index,
+                                                              telemetry=telemetry[index].translator):
+                            if event.event == CHUNK_PARTIAL_EVENT:
+                                yield event
+                            else:
+                                response = event
+                    yield complete_response(index, chunk, response)
+                self._finish_checkpoint(checkpoint, failed)
+                return
+
+            if translation_batch_tokens:
+                # the author stage runs ahead in the background while batches are being translated
+                summaries = stack.enter_context(contextlib.closing(
+                    _run_pipelined(summarize_chunk, lambda summarized: summarized, indexed_chunks,
+                                   queue_size=queue_size, max_workers=max_workers)))
+                responses = self._iter_batched_translations(summaries, batch_tokens=translation_batch_tokens,
+                                                            telemetry=telemetry)
+            elif pipelined:
+                responses = _run_pipelined(summarize_chunk, translate_summary, indexed_chunks,
+                                           queue_size=queue_size, max_workers=max_workers)
+            elif max_workers <= 1:
+                # parse the next chunk in the background while the current one is with the LLM
+                responses = _run_pipelined(lambda indexed_chunk: indexed_chunk, process_chunk, indexed_chunks,
+                                           queue_size=1)
+            else:
+                responses = _run_ordered(process_chunk, indexed_chunks, max_workers=max_workers)
+            for index, chunk, response in stack.enter_context(contextlib.closing(responses)):
+                yield complete_response(index, chunk, response)
+            self._finish_checkpoint(checkpoint, failed)
 
-            response = self._run_chunk(content=chunk_str, start_page=start_page, end_page=end_page)
+    def run_targets(self, pdf_file: Path, targets: Iterable[Tuple[str, str]], chunk_size=10, padding=1,
+                    skip_first_n_pages=0, max_workers=1, queue_size=2, extraction_workers=1,
+                    max_chunk_tokens: Optional[int] = None, overlap_tokens=0, checkpoint_dir: Optional[Path] = None,
+                    resume=False, translation_workers: Optional[int] = None,
+                    telemetry_sink: Optional[TelemetrySink] = None) -> Iterator[RunResponse]:
+        """
+        Converts the PDF to storybooks for several (language, level) targets at once. The author stage runs
+        once per chunk and its summary is translated for all targets in parallel, so the author calls don't
+        grow with the number of targets. The author stage of the next chunks runs ahead like in pipelined mode.
 
-            if response.event != "RunFailed":
-                response.metrics[
-                    'progress_info'] = f"Processed Pages: {skip_first_n_pages}-{end_page} of {total_pages}"
-                response.metrics['progress_total'] = total_chunks
-                response.metrics['progress_current_index'] = index + 1
-                response.metrics['progress_percent'] = int(((index + 1) / total_chunks) * 100)
-            yield response
+        Yields, chunk by chunk in page order, one response per target in the order of `targets`, with the
+        target in `metrics["language"]` and `metrics["level"]`. The chunk telemetry is added to the response
+        of the last target. Takes the chunking, checkpoint and telemetry options of `run`, but not `pipelined`,
+        `stream` and `translation_batch_tokens`.
+
+        Args:
+            targets: (language, level) pairs, e.g. [("German", "A2 Elementary"), ("French", "B1 Intermediate")].
+            checkpoint_dir: Saves every target in its own checkpoint, the same one a `run` with that language and
+                level uses.
+            translation_workers: Number of translator calls running at the same time, defaults to one per
+                target.
+        """
+        targets = list(dict.fromkeys(targets))
+        if not targets:
+            raise ValueError("targets must not be empty")
+        checkpoints = {
+            target: self._create_checkpoint(pdf_file, checkpoint_dir, resume, language=target[0], level=target[1],
+                                            chunk_size=chunk_size, padding=padding,
+                                            skip_first_n_pages=skip_first_n_pages,
+                                            max_chunk_tokens=max_chunk_tokens, overlap_tokens=overlap_tokens)
+            for target in targets
+        }
+        telemetry: Dict[int, ChunkTelemetry] = {}
+        executor = ThreadPoolExecutor(max_workers=translation_workers or len(targets),
+                                      thread_name_prefix="story_translator")
+
+        def summarize_chunk(indexed_chunk) -> Tuple[int, list, Optional[RunResponse], Dict[Tuple[str, str], Any]]:
+            index, chunk = indexed_chunk
+            restored = {target: self._restore_chunk(checkpoints[target] if resume else None, index, chunk)
+                        for target in targets}
+            summary = None
+            if any(response is None for response in restored.values()):
+                start_page, end_page = self._chunk_pages(chunk)
+                PhiLogger.info(f"Summarizing Pages: {start_page}-{end_page}")
+                telemetry[index].start_stage()
+                summary = self._summarize_chunk(content=self._chunk_text(chunk), start_page=start_page,
+                                                end_page=end_page, telemetry=telemetry[index].author,
+                                                author_agent=self._local_shared_author())
+                telemetry[index].end_stage()
+            return index, chunk, summary, restored
+
+        def translate_summary(summarized) -> Tuple[int, list, Dict[Tuple[str, str], RunResponse]]:
+            index, chunk, summary, responses = summarized
+            missing = [target for target, response in responses.items() if response is None]
+            if not missing:
+                return index, chunk, responses
+            start_page, end_page = self._chunk_pages(chunk)
+            if summary.event == "RunFailed":
+                # every target gets its own response, the target metrics are set on it
+                for target in missing:
+                    responses[target] = RunResponse(event="RunFailed", content=summary.content)
+                return index, chunk, responses
+            PhiLogger.info(f"Translating Pages: {start_page}-{end_page} to {len(missing)} targets")
+            telemetry[index].start_stage()
+            # agent telemetry isn't thread safe, every translation records into its own
+            translator_telemetry = {target: AgentTelemetry() for target in missing}
+            futures = {target: executor.submit(self._translate_summary, summary, start_page, end_page,
+                                               translator_telemetry[target], target)
+                       for target in missing}
+            for target, future in futures.items():
+                responses[target] = future.result()
+                telemetry[index].translator.merge(translator_telemetry[target])
+            telemetry[index].end_stage()
+            return index, chunk, responses
+
+        pages = self._open_pages(pdf_file, extraction_workers)
+        chunks = self._iter_chunks(pages, chunk_size=chunk_size, padding=padding, skip_first_n_pages=skip_first_n_pages,
+                                   max_chunk_tokens=max_chunk_tokens, overlap_tokens=overlap_tokens)
+        results = _run_pipelined(summarize_chunk, translate_summary, self._iter_indexed_chunks(chunks, telemetry),
+                                 queue_size=queue_size, max_workers=max_workers)
+        try:
+            failed = set()
+            for index, chunk, responses in results:
+                chunk_telemetry = telemetry.pop(index, None)
+                for number, target in enumerate(targets, start=1):
+                    response = responses[target]
+                    if response.event == "RunFailed":
+                        failed.add(target)
+                    response.metrics = {**(response.metrics or {}), "language": target[0], "level": target[1]}
+                    yield self._complete_response(index, chunk, response, checkpoints[target], chunk_size=chunk_size,
+                                                  skip_first_n_pages=skip_first_n_pages,
+                                                  max_chunk_tokens=max_chunk_tokens,
+                                                  telemetry=chunk_telemetry if number == len(targets) else None,
+                                                  telemetry_sink=telemetry_sink)
+            for target, checkpoint in checkpoints.items():
+                self._finish_checkpoint(checkpoint, target in failed)
+        finally:
+            # the pipeline is stopped before the pages it reads are closed
+            results.close()
+            executor.shutdown(wait=True, cancel_futures=True)
+            self._close_pages(pages)
+
+    async def arun(self, pdf_file: Path, chunk_size=10, padding=1, skip_first_n_pages=0, max_concurrency=1,
+                   extraction_workers=1, max_chunk_tokens: Optional[int] = None, overlap_tokens=0,
+                   checkpoint_dir: Optional[Path] = None, resume=False,
+                   semaphore: Optional[asyncio.Semaphore] = None,
+                   telemetry_sink: Optional[TelemetrySink] = None) -> AsyncIterator[RunResponse]:
+        """
+        Async version of `run`, built on the agents' async calls. Takes the chunking, extraction, checkpoint and
+        telemetry options of `run`: `chunk_size`, `padding`, `skip_first_n_pages`, `extraction_workers`,
+        `max_chunk_tokens`, `overlap_tokens`, `checkpoint_dir`, `resume` and `telemetry_sink`. There is no
+        `pipelined`, `stream` or `translation_batch_tokens` mode, and `max_concurrency` replaces `max_workers`.
+
+        Args:
+            max_concurrency: Number of chunks processed concurrently, responses are yielded in page order.
+            semaphore: Optional semaphore shared by several conversions running on the same event loop, bounds
+                the number of chunks processed at the same time across all of them.
+        """
+        checkpoint = await asyncio.to_thread(
+            self._create_checkpoint, pdf_file, checkpoint_dir, resume, chunk_size=chunk_size, padding=padding,
+            skip_first_n_pages=skip_first_n_pages, max_chunk_tokens=max_chunk_tokens, overlap_tokens=overlap_tokens
+        )
+        restore_from = checkpoint if resume else None
+        chunk_semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        telemetry: Dict[int, ChunkTelemetry] = {}
+        pages = self._open_pages(pdf_file, extraction_workers)
+        chunks = self._iter_chunks(pages, chunk_size=chunk_size, padding=padding, skip_first_n_pages=skip_first_n_pages,
+                                   max_chunk_tokens=max_chunk_tokens, overlap_tokens=overlap_tokens)
+        indexed_chunks = self._iter_indexed_chunks(chunks, telemetry)
+        failed = False
+
+        async def process_chunk(index, chunk) -> RunResponse:
+            restored = self._restore_chunk(restore_from, index, chunk)
+            if restored is not None:
+                return restored
+            async with chunk_semaphore:
+                async with semaphore or contextlib.nullcontext():
+                    start_page, end_page = self._chunk_pages(chunk)
+                    PhiLogger.info(f"Processing Pages: {start_page}-{end_page}")
+                    telemetry[index].start_stage()
+                    return await self._arun_chunk(content=self._chunk_text(chunk), start_page=start_page,
+                                                  end_page=end_page, telemetry=telemetry[index])
+
+        def complete_response(index, chunk, response: RunResponse) -> RunResponse:
+            nonlocal failed
+            failed = failed or response.event == "RunFailed"
+            return self._complete_response(index, chunk, response, checkpoint, chunk_size=chunk_size,
+                                           skip_first_n_pages=skip_first_n_pages, max_chunk_tokens=max_chunk_tokens,
+                                           telemetry=telemetry.pop(index, None), telemetry_sink=telemetry_sink)
+
+        pending = deque()
+        try:
+            while True:
+                # PDF parsing is blocking, it runs in a thread while the event loop serves the agent calls
+                indexed_chunk = await asyncio.to_thread(next, indexed_chunks, None)
+                if indexed_chunk is None:
+                    break
+                index, chunk = indexed_chunk
+                pending.append((index, chunk, asyncio.create_task(process_chunk(index, chunk))))
+                while len(pending) >= 2 * max(1, max_concurrency):
+                    head_index, head_chunk, task = pending.popleft()
+                    yield complete_response(head_index, head_chunk, await task)
+            while pending:
+                head_index, head_chunk, task = pending.popleft()
+                yield complete_response(head_index, head_chunk, await task)
+            await asyncio.to_thread(self._finish_checkpoint, checkpoint, failed)
+        finally:
+            for _, _, task in pending:
+                task.cancel()
+            await asyncio.to_thread(self._close_pages, pages)
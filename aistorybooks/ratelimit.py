@@ -0,0 +1,252 @@
+import asyncio
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict, Callable, Any
+
+from tenacity import (AsyncRetrying, Retrying, RetryCallState, retry_if_exception, stop_after_attempt,
+                      wait_random_exponential)
+
+from aistorybooks.config import Config
+
+
+# only errors wrapping a 429 response in their message, a bare "429" or "rate limit" also shows up in token
+# counts, request ids and unrelated error texts
+_RATE_LIMIT_MESSAGE = re.compile(
+    r"(?i:\b429\b\W{0,3}(?:too many requests|resource (?:has been )?exhausted))"
+    r"|(?i:too many requests\W{0,3}\(?\b429\b)"
+    r"|\bRESOURCE_EXHAUSTED\b"
+)
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """Detects rate limit errors of the openai, google and httpx clients without importing them."""
+    for status in (getattr(error, "status_code", None), getattr(error, "code", None),
+                   getattr(getattr(error, "response", None), "status_code", None)):
+        if status == 429:
+            return True
+    if type(error).__name__ in ("RateLimitError", "ResourceExhausted", "TooManyRequests"):
+        return True
+    return _RATE_LIMIT_MESSAGE.search(str(error)) is not None
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """Returns the retry delay the provider asked for, from the retry-after header or the error message."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    value = headers.get("retry-after") if headers is not None else None
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    # gemini reports it in the message, "Please retry in 23.5s" or "retry_delay { seconds: 23 }"
+    match = re.search(r"retry in ([\d.]+)\s*s|retry_delay\s*{\s*seconds:\s*(\d+)", str(error))
+    if match:
+        return float(match.group(1) or match.group(2))
+    return None
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at `rate_per_minute`. Callers reserve capacity in arrival
+    order, a caller that can't be served right away gets the time it has to wait.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.rate_per_minute = rate_per_minute
+        self.capacity = capacity or rate_per_minute
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated_at
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate_per_minute / 60)
+        self._updated_at = now
+
+    def reserve(self, amount: float) -> float:
+        """Takes `amount` from the bucket and returns the seconds to wait before using it."""
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            self._tokens -= min(amount, self.capacity)
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens * 60 / self.rate_per_minute
+
+    def consume(self, amount: float):
+        """Charges `amount` without waiting, for usage only known after the call."""
+        with self._lock:
+            self._refill(self._clock())
+            self._tokens -= amount
+
+    def set_rate(self, rate_per_minute: float):
+        with self._lock:
+            self._refill(self._clock())
+            self.rate_per_minute = rate_per_minute
+
+
+class RateLimiter:
+    """
+    Requests and tokens per minute limits for one provider model, with retries of rate limited calls.
+
+    Rate limited calls are retried with jittered exponential backoff, or after the delay the provider asked
+    for. A rate limit error pauses all callers sharing the limiter and lowers the request rate, which then
+    recovers step by step on successful calls.
+    """
+    _registry: Dict[str, "RateLimiter"] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(
+            self,
+            requests_per_minute: Optional[float] = None,
+            tokens_per_minute: Optional[float] = None,
+            max_retries: int = 6,
+            min_backoff: float = 1,
+            max_backoff: float = 90,
+            sleep: Callable[[float], Any] = time.sleep,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.max_retries = max_retries
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._sleep = sleep
+        self._clock = clock
+        self._requests = TokenBucket(requests_per_minute, clock=clock) if requests_per_minute else None
+        self._tokens = TokenBucket(tokens_per_minute, clock=clock) if tokens_per_minute else None
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.throttled = 0
+        self.throttle_seconds = 0.0
+        self.rate_limited = 0
+        self.retries = 0
+
+    @classmethod
+    def for_model(cls, model_id: str) -> "RateLimiter":
+        """Returns the process-wide limiter of the model, configured from `Config.RATE_LIMITS`."""
+        with cls._registry_lock:
+            if model_id not in cls._registry:
+                cls._registry[model_id] = cls(**Config.RATE_LIMITS.get(model_id, {}))
+            return cls._registry[model_id]
+
+    def _wait_time(self, tokens: float) -> float:
+        wait = max(0.0, self._paused_until - self._clock())
+        if self._requests is not None:
+            wait = max(wait, self._requests.reserve(1))
+        if self._tokens is not None and tokens:
+            wait = max(wait, self._tokens.reserve(tokens))
+        return wait
+
+    def _throttle(self, tokens: float) -> float:
+        wait = self._wait_time(tokens)
+        if wait > 0:
+            with self._lock:
+                self.throttled += 1
+                self.throttle_seconds += wait
+        return wait
+
+    def acquire(self, tokens: float = 0) -> float:
+        """Blocks until a request using `tokens` fits into the limits, returns the seconds waited."""
+        wait = self._throttle(tokens)
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+
+    async def aacquire(self, tokens: float = 0) -> float:
+        wait = self._throttle(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def record_usage(self, tokens: float):
+        """Charges tokens that were only known after the call, like the output tokens."""
+        if self._tokens is not None and tokens:
+            self._tokens.consume(tokens)
+
+    def _backoff(self, retry_state: RetryCallState) -> float:
+        error = retry_state.outcome.exception()
+        delay = retry_after_seconds(error)
+        if delay is None:
+            delay = wait_random_exponential(multiplier=self.min_backoff, max=self.max_backoff)(retry_state)
+        return delay
+
+    def _on_rate_limited(self, retry_state: RetryCallState):
+        delay = retry_state.next_action.sleep if retry_state.next_action else 0
+        with self._lock:
+            self.rate_limited += 1
+            self.retries += 1
+            self._paused_until = max(self._paused_until, self._clock() + delay)
+            if self._requests is not None:
+                self._requests.set_rate(max(self.requests_per_minute * 0.1, self._requests.rate_per_minute * 0.75))
+
+    def record_success(self):
+        """Lets the request rate recover a step after a rate limit error."""
+        if self._requests is not None and self._requests.rate_per_minute < self.requests_per_minute:
+            with self._lock:
+                self._requests.set_rate(min(self.requests_per_minute,
+                                            self._requests.rate_per_minute + self.requests_per_minute * 0.05))
+
+    def retrying(self) -> Retrying:
+        """
+        Retry controller for calls that can't be wrapped into a function, like streamed responses. The caller
+        acquires the limits and records the success within every attempt:
+
+            for attempt in limiter.retrying():
+                with attempt:
+                    limiter.acquire(tokens)
+                    ...
+                    limiter.record_success()
+        """
+        return Retrying(
+            retry=retry_if_exception(is_rate_limit_error),
+            wait=self._backoff,
+            stop=stop_after_attempt(self.max_retries + 1),
+            before_sleep=self._on_rate_limited,
+            sleep=self._sleep,
+            reraise=True,
+        )
+
+    def call(self, func: Callable, *args, tokens: float = 0, **kwargs):
+        """Calls `func` within the limits, retrying it when it fails with a rate limit error."""
+
+        def attempt():
+            self.acquire(tokens)
+            result = func(*args, **kwargs)
+            self.record_success()
+            return result
+
+        return self.retrying()(attempt)
+
+    async def acall(self, func: Callable, *args, tokens: float = 0, **kwargs):
+        """Async version of `call`, `func` is a coroutine function."""
+
+        async def attempt():
+            await self.aacquire(tokens)
+            result = await func(*args, **kwargs)
+            self.record_success()
+            return result
+
+        retrying = AsyncRetrying(
+            retry=retry_if_exception(is_rate_limit_error),
+            wait=self._backoff,
+            stop=stop_after_attempt(self.max_retries + 1),
+            before_sleep=self._on_rate_limited,
+            reraise=True,
+        )
+        return await retrying(attempt)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "throttled": self.throttled,
+            "throttle_seconds": round(self.throttle_seconds, 3),
+            "rate_limited": self.rate_limited,
+            "retries": self.retries,
+            "requests_per_minute": self._requests.rate_per_minute if self._requests else None,
+        }
@@ -0,0 +1,59 @@
+import os
+from pathlib import Path
+from typing import Optional, BinaryIO
+
+
+class StorybookBuffer:
+    """
+    Append-only storybook markdown on disk, written chunk by chunk and read back in slices.
+
+    Next to the markdown file an index file records the end offset of every completed chunk. Readers only
+    see completed chunks, so a reader polling the file while a chunk is being written never gets a torn
+    chunk, and can fetch just the text added since its last read.
+    """
+    SEPARATOR = "\n\n"
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.index_path = self.path.with_name(f"{self.path.name}.idx")
+
+    def append(self, text: str):
+        """Appends one chunk, the chunk is visible to readers once this returns."""
+        data = f"{self.SEPARATOR}{text}".encode("utf-8")
+        with open(self.path, "ab") as f:
+            f.write(data)
+            f.flush()
+            end = f.tell()
+        with open(self.index_path, "a", encoding="utf-8") as index:
+            index.write(f"{end}\n")
+
+    def _offsets(self):
+        if not self.index_path.exists():
+            return []
+        return [int(line) for line in self.index_path.read_text(encoding="utf-8").split()]
+
+    def size(self) -> int:
+        """Returns the size in bytes of the completed chunks."""
+        offsets = self._offsets()
+        return offsets[-1] if offsets else 0
+
+    def __len__(self) -> int:
+        return len(self._offsets())
+
+    def read(self, start: int = 0, end: Optional[int] = None) -> str:
+        """Returns the text between the byte offsets `start` and `end`, both chunk boundaries returned by `size`."""
+        end = self.size() if end is None else end
+        if end <= start:
+            return ""
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            return f.read(end - start).decode("utf-8")
+
+    def open(self) -> BinaryIO:
+        """Opens the markdown for reading, to stream it without loading it into memory."""
+        return open(self.path, "rb")
+
+    def clear(self):
+        for file in (self.path, self.index_path):
+            if file.exists():
+                os.remove(file)
@@ -0,0 +1,216 @@
+import dataclasses
+import json
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Any, Optional, List
+
+from aistorybooks.osutils import write_atomic
+
+AGENTS = ("author", "translator")
+
+
+def _token_count(value) -> int:
+    # phi keeps one entry per model request
+    if isinstance(value, list):
+        return int(sum(value))
+    return int(value or 0)
+
+
+@dataclass
+class AgentTelemetry:
+    """Calls of one agent for one chunk."""
+    calls: int = 0
+    seconds: float = 0.0
+    retries: int = 0
+    cache_hits: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+
+    def add_call(self, seconds: float, attempts: int = 1, metrics: Optional[Dict[str, Any]] = None, share: float = 1):
+        """
+        Records one call. A call serving several chunks is recorded in each of them, with `share` being the
+        part of its time and tokens attributed to this chunk.
+        """
+        metrics = metrics or {}
+        self.calls += 1
+        self.seconds += seconds * share
+        self.retries += max(0, attempts - 1)
+        self.cache_hits += 1 if metrics.get("cache_hit") else 0
+        self.input_tokens += round(_token_count(metrics.get("input_tokens")) * share)
+        self.output_tokens += round(_token_count(metrics.get("output_tokens")) * share)
+
+    def add_share(self, other: "AgentTelemetry", share: float, count: bool):
+        """
+        Adds `share` of the time and tokens of the calls recorded in `other`, calls serving several chunks. The
+        calls, retries and cache hits are only added when `count` is set, so they are counted in one chunk only.
+        """
+        if count:
+            self.calls += other.calls
+            self.retries += other.retries
+            self.cache_hits += other.cache_hits
+        self.seconds += other.seconds * share
+        self.input_tokens += round(other.input_tokens * share)
+        self.output_tokens += round(other.output_tokens * share)
+
+    def merge(self, other: "AgentTelemetry"):
+        """Adds the calls recorded in `other`."""
+        for name in ("calls", "seconds", "retries", "cache_hits", "input_tokens", "output_tokens"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+
+@dataclass
+class ChunkTelemetry:
+    """Timings and token usage of one chunk of a storybook run, emitted with the chunk response."""
+    index: int
+    start_page: int
+    end_page: int
+    model: str = ""
+    extraction_seconds: float = 0.0
+    # time the chunk waited for a worker or for the next stage
+    queue_wait_seconds: float = 0.0
+    total_seconds: float = 0.0
+    resumed: bool = False
+    failed: bool = False
+    author: AgentTelemetry = field(default_factory=AgentTelemetry)
+    translator: AgentTelemetry = field(default_factory=AgentTelemetry)
+    created_at: float = field(default_factory=time.perf_counter, repr=False)
+    ready_at: float = field(default_factory=time.perf_counter, repr=False)
+
+    @property
+    def pages(self) -> int:
+        return self.end_page - self.start_page + 1
+
+    def start_stage(self):
+        self.queue_wait_seconds += max(0.0, time.perf_counter() - self.ready_at)
+
+    def end_stage(self):
+        self.ready_at = time.perf_counter()
+
+    def complete(self, failed: bool = False, resumed: bool = False):
+        self.failed = failed
+        self.resumed = resumed
+        self.total_seconds = time.perf_counter() - self.created_at
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = dataclasses.asdict(self)
+        del data["created_at"], data["ready_at"]
+        data["pages"] = self.pages
+        return data
+
+
+class TelemetrySink:
+    """Receives the telemetry of every completed chunk."""
+
+    def record(self, telemetry: ChunkTelemetry):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class TelemetrySummary(TelemetrySink):
+    """Running totals over the chunks of one or more runs, kept in memory."""
+
+    def __init__(self):
+        self.chunks = {"ok": 0, "failed": 0, "resumed": 0}
+        self.pages = 0
+        self.seconds = {"extraction": 0.0, "queue_wait": 0.0, "total": 0.0}
+        self.agents = {agent: AgentTelemetry() for agent in AGENTS}
+        self.model = ""
+
+    def record(self, telemetry: ChunkTelemetry):
+        status = "failed" if telemetry.failed else "resumed" if telemetry.resumed else "ok"
+        self.chunks[status] += 1
+        self.pages += telemetry.pages
+        self.model = telemetry.model or self.model
+        self.seconds["extraction"] += telemetry.extraction_seconds
+        self.seconds["queue_wait"] += telemetry.queue_wait_seconds
+        self.seconds["total"] += telemetry.total_seconds
+        for agent in AGENTS:
+            self.agents[agent].merge(getattr(telemetry, agent))
+
+    def to_dict(self) -> Dict[str, Any]:
+        tokens = sum(agent.input_tokens + agent.output_tokens for agent in self.agents.values())
+        return {
+            "model": self.model,
+            "chunks": dict(self.chunks),
+            "pages": self.pages,
+            "seconds": {name: round(value, 3) for name, value in self.seconds.items()},
+            "agents": {name: dataclasses.asdict(agent) for name, agent in self.agents.items()},
+            "tokens_per_page": round(tokens / self.pages, 1) if self.pages else 0,
+        }
+
+
+class TelemetrySinks(TelemetrySink):
+    """Passes the telemetry on to several sinks."""
+
+    def __init__(self, *sinks: TelemetrySink):
+        self.sinks = sinks
+
+    def record(self, telemetry: ChunkTelemetry):
+        for sink in self.sinks:
+            sink.record(telemetry)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+class JsonlTelemetrySink(TelemetrySink):
+    """Appends one JSON line per chunk."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def record(self, telemetry: ChunkTelemetry):
+        line = json.dumps({"time": time.time(), **telemetry.to_dict()})
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(f"{line}\n")
+
+
+class PrometheusTelemetrySink(TelemetrySink):
+    """
+    Keeps totals in the Prometheus text format, rewritten to `path` after every chunk, for the node exporter
+    textfile collector or any scraper reading the file.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.summary = TelemetrySummary()
+        self._lock = threading.Lock()
+
+    def render(self) -> str:
+        summary = self.summary
+        model = summary.model
+        lines: List[str] = []
+
+        def metric(name: str, kind: str, help_text: str, samples: Dict[str, float]):
+            lines.append(f"# HELP aistorybooks_{name} {help_text}")
+            lines.append(f"# TYPE aistorybooks_{name} {kind}")
+            for labels, value in samples.items():
+                lines.append(f'aistorybooks_{name}{{model="{model}"{labels}}} {value}')
+
+        metric("chunks_total", "counter", "Completed chunks by status.",
+               {f',status="{status}"': count for status, count in summary.chunks.items()})
+        metric("pages_total", "counter", "Pages of the completed chunks.", {"": summary.pages})
+        metric("stage_seconds_total", "counter", "Seconds spent per stage.",
+               {**{f',stage="{stage}"': round(seconds, 3) for stage, seconds in summary.seconds.items()},
+                **{f',stage="{agent}"': round(telemetry.seconds, 3) for agent, telemetry in summary.agents.items()}})
+        for name, help_text in (("calls", "Agent calls."), ("retries", "Rate limited agent calls retried."),
+                                ("cache_hits", "Agent calls served from the response cache.")):
+            metric(f"agent_{name}_total", "counter", help_text,
+                   {f',agent="{agent}"': getattr(telemetry, name) for agent, telemetry in summary.agents.items()})
+        metric("agent_tokens_total", "counter", "Tokens used by the agents.",
+               {f',agent="{agent}",direction="{direction}"': getattr(telemetry, f"{direction}_tokens")
+                for agent, telemetry in summary.agents.items() for direction in ("input", "output")})
+        return "\n".join(lines) + "\n"
+
+    def record(self, telemetry: ChunkTelemetry):
+        with self._lock:
+            self.summary.record(telemetry)
+            write_atomic(self.path, self.render())
@@ -1,39 +1,417 @@
-import pickle
-import pymupdf4llm
+import hashlib
+import json
+import math
+import mmap
+import os
+import pymupdf
+import shutil
+import tempfile
+import warnings
+from collections.abc import Sequence
+from importlib.metadata import version
 from llama_index.core.schema import Document
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Iterable, Iterator, Dict, Any, Callable
+
+from aistorybooks.config import Config
+from aistorybooks.osutils import spawn_process_pool
+
+# bump when the page extraction output changes, it invalidates all cached extractions
+EXTRACTOR_VERSION = f"1-pymupdf4llm-{version('pymupdf4llm')}"
+
+
+class CachedPages(Sequence):
+    """
+    Read-only, lazily loaded list of page `Document`s stored by `PdfExtractionCache`.
+
+    Page texts are stored back to back in one memory-mapped file, separated by blank lines, `Document`
+    objects are only created for the pages that are accessed. Close it, or use it as a context manager, to
+    release the file.
+    """
+    SEPARATOR = "\n\n"
+
+    def __init__(self, directory: Path, file_path: Optional[Path] = None):
+        index = json.loads(directory.joinpath("index.json").read_text(encoding="utf-8"))
+        self._common: Dict[str, Any] = index["common"]
+        if file_path is not None:
+            self._common["file_path"] = str(file_path)
+        self._pages: List[list] = index["pages"]
+        self._file = open(directory.joinpath("pages.md"), "rb")
+        # mmap can't map empty files
+        self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.fstat(self._file.fileno()).st_size else b""
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        start, end, extra_info = self._pages[index]
+        return Document(text=self._buffer[start:end].decode("utf-8"), extra_info={**self._common, **extra_info})
+
+    def text_range(self, start: int, end: int) -> str:
+        """Returns the text of pages `start` to `end` (exclusive) joined with blank lines, as one slice."""
+        if start >= end:
+            return ""
+        return self._buffer[self._pages[start][0]:self._pages[end - 1][1]].decode("utf-8")
+
+    def close(self):
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._file.close()
+
+    def __enter__(self) -> "CachedPages":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DocumentChunk(Sequence):
+    """
+    View over the pages `start` to `end` (exclusive) of a page list, no pages are copied. The chunk text is
+    built on access, as a single slice when the pages come from `CachedPages`.
+    """
+
+    def __init__(self, pages: Sequence, start: int, end: int):
+        self.pages = pages
+        self.start = start
+        self.end = end
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.pages[self.start + i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chunk index out of range")
+        return self.pages[self.start + index]
+
+    @property
+    def text(self) -> str:
+        if isinstance(self.pages, CachedPages):
+            return self.pages.text_range(self.start, self.end)
+        return CachedPages.SEPARATOR.join(self.pages[i].text for i in range(self.start, self.end))
+
+    def __repr__(self) -> str:
+        return f"DocumentChunk(start={self.start}, end={self.end})"
+
+
+class PdfExtractionCache:
+    """
+    On-disk cache of extracted PDF pages, keyed by the hash of the PDF bytes and the extractor version.
+    """
+
+    def __init__(self, cache_dir: Optional[Path] = None):
+        self.cache_dir = Path(cache_dir) if cache_dir else Config.CACHE_DIR.joinpath("pdf_extractions")
+
+    @staticmethod
+    def key(pdf_file: Path) -> str:
+        return hashlib.sha256(f"{PdfUtil.file_hash(pdf_file)}:{EXTRACTOR_VERSION}".encode("utf-8")).hexdigest()
+
+    def load(self, key: str, pdf_file: Optional[Path] = None) -> Optional[CachedPages]:
+        directory = self.cache_dir.joinpath(key)
+        if not directory.joinpath("index.json").exists():
+            return None
+        return CachedPages(directory, file_path=pdf_file)
+
+    def save(self, key: str, pages: Iterable[Document], pdf_file: Optional[Path] = None) -> CachedPages:
+        for _ in self.save_iter(key, pages):
+            pass
+        return CachedPages(self.cache_dir.joinpath(key), file_path=pdf_file)
+
+    def save_iter(self, key: str, pages: Iterable[Document]) -> Iterator[Document]:
+        """
+        Writes the pages to the cache while passing them through, the entry becomes visible once all pages
+        are consumed. Nothing is stored when the iteration is stopped early.
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        temp_dir = Path(tempfile.mkdtemp(prefix=f".{key}_", dir=self.cache_dir))
+        try:
+            common: Optional[Dict[str, Any]] = None
+            index_pages = []
+            offset = 0
+            with open(temp_dir.joinpath("pages.md"), "wb") as f:
+                for page in pages:
+                    extra_info = dict(page.extra_info)
+                    if common is None:
+                        common = {k: v for k, v in extra_info.items() if k != "page"}
+                    if index_pages:
+                        offset += f.write(CachedPages.SEPARATOR.encode("utf-8"))
+                    data = page.text.encode("utf-8")
+                    f.write(data)
+                    index_pages.append([offset, offset + len(data),
+                                        {k: v for k, v in extra_info.items() if common.get(k, object()) != v}])
+                    offset += len(data)
+                    yield page
+            temp_dir.joinpath("index.json").write_text(
+                json.dumps({"version": EXTRACTOR_VERSION, "common": common or {}, "pages": index_pages}),
+                encoding="utf-8"
+            )
+            target = self.cache_dir.joinpath(key)
+            if target.exists():
+                shutil.rmtree(target)
+            temp_dir.rename(target)
+        finally:
+            if temp_dir.exists():
+                shutil.rmtree(temp_dir)
+
+
+def _page_document(doc: pymupdf.Document, pdf_file: Path, page_number: int, hdr_info) -> Document:
+    # imported on first use, it takes about a second and isn't needed when the pages come from the cache
+    import pymupdf4llm.helpers.pymupdf_rag
+
+    extra_info = dict(doc.metadata)
+    extra_info["page"] = page_number + 1
+    extra_info["total_pages"] = len(doc)
+    extra_info["file_path"] = str(pdf_file)
+    text = pymupdf4llm.helpers.pymupdf_rag.to_markdown(doc, pages=[page_number], hdr_info=hdr_info)
+    return Document(text=text, extra_info=extra_info)
+
+
+def _extract_page_range(pdf_file: Path, start: int, end: int, hdr_info) -> List[Document]:
+    """Process pool task, opens the document independently and converts pages `start` to `end` (exclusive)."""
+    with pymupdf.open(pdf_file) as doc:
+        return [_page_document(doc, pdf_file, page_number, hdr_info) for page_number in range(start, end)]
 
 
 class PdfUtil:
+    # rough average for english and other latin script languages
+    CHARS_PER_TOKEN = 4
 
     @staticmethod
-    def process_pdf_file(pdf_file: Path, save_to_pickle: bool = False) -> List[Document]:
-        pickle_file = pdf_file.parent.joinpath(f"{pdf_file.stem}.pkl")
+    def file_hash(file: Path) -> str:
+        digest = hashlib.sha256()
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
 
-        if pickle_file.exists() and save_to_pickle is True:
-            print(f"Loading data from pickle file: {pickle_file}")
-            with open(pickle_file, "rb") as f:
-                data = pickle.load(f)
-        else:
+    @staticmethod
+    def iter_pdf_pages(pdf_file: Path, workers: int = 1, pages_per_task: Optional[int] = None) -> Iterator[
+        Document]:
+        """
+        Converts the PDF to markdown page by page, yielding each page `Document` as soon as it is converted.
+        Produces the same documents as `pymupdf4llm.LlamaMarkdownReader().load_data`.
+
+        Args:
+            workers: Number of processes converting pages in parallel, each one converts a range of pages.
+                Pages are still yielded in order.
+            pages_per_task: Size of the page ranges handed to the workers, small ranges get the first pages
+                out sooner.
+        """
+        import pymupdf4llm.helpers.pymupdf_rag
+
+        with pymupdf.open(pdf_file) as doc:
+            hdr_info = pymupdf4llm.helpers.pymupdf_rag.IdentifyHeaders(doc)
+            total_pages = len(doc)
+            if workers <= 1 or total_pages <= 1:
+                for page_number in range(total_pages):
+                    yield _page_document(doc, pdf_file, page_number, hdr_info)
+                return
+
+        if pages_per_task is None:
+            pages_per_task = max(1, min(10, math.ceil(total_pages / (workers * 4))))
+        ranges = [(start, min(total_pages, start + pages_per_task)) for start in
+                  range(0, total_pages, pages_per_task)]
+        with spawn_process_pool(min(workers, len(ranges))) as executor:
+            futures = [executor.submit(_extract_page_range, pdf_file, start, end, hdr_info) for start, end in ranges]
+            try:
+                for future in futures:
+                    yield from future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    @staticmethod
+    def iter_process_pdf_file(pdf_file: Path, use_cache: bool = False,
+                              cache: Optional[PdfExtractionCache] = None, workers: int = 1) -> Iterable[Document]:
+        """
+        Streaming version of `process_pdf_file`, pages are written to the cache while they are converted.
+        Returns the `CachedPages` directly when the extraction is already cached.
+        """
+        if cache is None and use_cache:
+            cache = PdfExtractionCache()
+
+        if cache is None:
             print(f"Processing PDF file: {pdf_file}")
-            reader = pymupdf4llm.LlamaMarkdownReader()
-            data: List[Document] = reader.load_data(pdf_file)
+            return PdfUtil.iter_pdf_pages(pdf_file, workers=workers)
 
-            if save_to_pickle:
-                print(f"Saving data to pickle file: {pickle_file}")
-                with open(pickle_file, "wb") as f:
-                    pickle.dump(data, f)
+        key = cache.key(pdf_file)
+        data = cache.load(key, pdf_file=pdf_file)
+        if data is not None:
+            print(f"Loading data from extraction cache: {cache.cache_dir.joinpath(key)}")
+            return data
+        print(f"Processing PDF file: {pdf_file}, saving to extraction cache: {cache.cache_dir.joinpath(key)}")
+        return cache.save_iter(key, PdfUtil.iter_pdf_pages(pdf_file, workers=workers))
+
+    @staticmethod
+    def process_pdf_file(pdf_file: Path, use_cache: bool = False,
+                         cache: Optional[PdfExtractionCache] = None, workers: int = 1,
+                         save_to_pickle: Optional[bool] = None) -> Sequence:
+        """
+        Converts the PDF pages to markdown `Document`s, one per page.
+
+        Args:
+            use_cache: Loads/stores the extraction from the default `PdfExtractionCache`.
+            cache: Extraction cache to use, implies `use_cache`.
+            workers: Number of processes used for the conversion, see `iter_pdf_pages`.
+            save_to_pickle: Deprecated alias of `use_cache`, the extraction cache replaced the pickle file.
+        """
+        if save_to_pickle is not None:
+            warnings.warn("save_to_pickle is deprecated, use use_cache", DeprecationWarning, stacklevel=2)
+            use_cache = use_cache or save_to_pickle
+        if cache is None and use_cache:
+            cache = PdfExtractionCache()
+
+        if cache is None:
+            print(f"Processing PDF file: {pdf_file}")
+            return list(PdfUtil.iter_pdf_pages(pdf_file, workers=workers))
 
+        key = cache.key(pdf_file)
+        data = cache.load(key, pdf_file=pdf_file)
+        if data is not None:
+            print(f"Loading data from extraction cache: {cache.cache_dir.joinpath(key)}")
+        else:
+            print(f"Processing PDF file: {pdf_file}, saving to extraction cache: {cache.cache_dir.joinpath(key)}")
+            data = cache.save(key, PdfUtil.iter_pdf_pages(pdf_file, workers=workers), pdf_file=pdf_file)
         return data
 
     @staticmethod
-    def split_document_into_chunks(data: List[Document], chunk_size: int, padding: int, skip_first_n_pages=0) -> List[
-        List[Document]]:
-        chunks: List[List[Document]] = []
-        for i in range(skip_first_n_pages, len(data), chunk_size):
-            start_index = max(skip_first_n_pages, i - padding)
-            end_index = min(len(data), i + chunk_size + padding)
-            chunk_pages = data[start_index:end_index]
-            chunks.append(chunk_pages)
-        return chunks
+    def iter_document_chunks(pages: Iterable[Document], chunk_size: int, padding: int,
+                             skip_first_n_pages=0) -> Iterator[DocumentChunk]:
+        """
+        Streaming version of `split_document_into_chunks`, a chunk is yielded as soon as its last page
+        (including the padding) arrives. Only the pages still needed by the next chunk are kept in memory.
+        Chunks are `DocumentChunk` views, over `pages` itself when it is a sequence.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        if isinstance(pages, Sequence):
+            for i in range(skip_first_n_pages, len(pages), chunk_size):
+                start_index = max(skip_first_n_pages, i - padding)
+                end_index = min(len(pages), i + chunk_size + padding)
+                yield DocumentChunk(pages, start_index, end_index)
+            return
+
+        buffer: List[Document] = []
+        buffer_start = skip_first_n_pages
+        next_start = skip_first_n_pages
+        total = 0
+
+        def next_chunk() -> DocumentChunk:
+            nonlocal buffer, buffer_start, next_start
+            start_index = max(skip_first_n_pages, next_start - padding)
+            end_index = min(total, next_start + chunk_size + padding)
+            chunk = DocumentChunk(buffer, start_index - buffer_start, end_index - buffer_start)
+            next_start += chunk_size
+            keep_from = max(skip_first_n_pages, next_start - padding)
+            # a new list, the chunks already handed out keep viewing the old one
+            buffer = buffer[keep_from - buffer_start:]
+            buffer_start = keep_from
+            return chunk
+
+        for page in pages:
+            total += 1
+            if total > buffer_start:
+                buffer.append(page)
+            while total >= next_start + chunk_size + padding:
+                yield next_chunk()
+        while next_start < total:
+            yield next_chunk()
+
+    @staticmethod
+    def split_document_into_chunks(data: Sequence, chunk_size: int, padding: int, skip_first_n_pages=0) -> List[
+        DocumentChunk]:
+        return list(PdfUtil.iter_document_chunks(data, chunk_size, padding, skip_first_n_pages))
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """Fast token estimate, close enough to the provider tokenizers for budgeting requests."""
+        return math.ceil(len(text) / PdfUtil.CHARS_PER_TOKEN)
+
+    @staticmethod
+    def _split_text(text: str, max_tokens: int, token_counter: Callable[[str], int]) -> List[str]:
+        """Splits the text into parts within `max_tokens`, at paragraph, line or word boundaries when possible."""
+        tokens = token_counter(text)
+        if tokens <= max_tokens:
+            return [text]
+        for separator in ("\n\n", "\n", " "):
+            parts = text.split(separator)
+            if len(parts) == 1:
+                continue
+            pieces: List[str] = []
+            current = None
+            for part in parts:
+                candidate = part if current is None else current + separator + part
+                if current is None or token_counter(candidate) <= max_tokens:
+                    current = candidate
+                else:
+                    pieces.append(current)
+                    current = part
+            pieces.append(current)
+            return [split for piece in pieces for split in PdfUtil._split_text(piece, max_tokens, token_counter)]
+        cut = max(1, len(text) * max_tokens // tokens)
+        return [text[:cut]] + PdfUtil._split_text(text[cut:], max_tokens, token_counter)
+
+    @staticmethod
+    def iter_token_chunks(pages: Iterable[Document], max_tokens: int, overlap_tokens: int = 0, skip_first_n_pages=0,
+                          token_counter: Optional[Callable[[str], int]] = None) -> Iterator[List[Document]]:
+        """
+        Packs pages into chunks of at most `max_tokens`, instead of a fixed number of pages.
+
+        Each chunk starts with the trailing pages of the previous chunk that fit into `overlap_tokens`. Pages
+        larger than the budget are split into several documents carrying the same `extra_info`.
+        """
+        if max_tokens < 1:
+            raise ValueError("max_tokens must be at least 1")
+        token_counter = token_counter or PdfUtil.estimate_tokens
+        overlap_tokens = min(overlap_tokens, max_tokens // 2)
+        chunk: List[Document] = []
+        chunk_tokens: List[int] = []
+        new_pages = 0
+
+        def overlap():
+            keep = 0
+            kept_tokens = 0
+            for tokens in reversed(chunk_tokens):
+                if kept_tokens + tokens > overlap_tokens:
+                    break
+                kept_tokens += tokens
+                keep += 1
+            overlap_chunk = chunk[len(chunk) - keep:]
+            overlap_chunk_tokens = chunk_tokens[len(chunk_tokens) - keep:]
+            if keep < len(chunk) and overlap_tokens - kept_tokens > 0:
+                # fill the rest of the overlap with the tail of the next page, starting at a word boundary
+                page = chunk[len(chunk) - keep - 1]
+                tokens = chunk_tokens[len(chunk_tokens) - keep - 1]
+                cut = len(page.text) - len(page.text) * (overlap_tokens - kept_tokens) // max(1, tokens)
+                space = page.text.find(" ", cut)
+                tail = page.text[space + 1:] if space >= 0 else ""
+                if tail and token_counter(tail) <= overlap_tokens - kept_tokens:
+                    overlap_chunk.insert(0, Document(text=tail, extra_info=dict(page.extra_info)))
+                    overlap_chunk_tokens.insert(0, token_counter(tail))
+            return overlap_chunk, overlap_chunk_tokens
+
+        for index, page in enumerate(pages):
+            if index < skip_first_n_pages:
+                continue
+            for text in PdfUtil._split_text(page.text, max_tokens, token_counter):
+                part = page if text is page.text else Document(text=text, extra_info=dict(page.extra_info))
+                tokens = token_counter(text)
+                if new_pages and sum(chunk_tokens) + tokens > max_tokens:
+                    yield chunk
+                    chunk, chunk_tokens = overlap()
+                    new_pages = 0
+                while chunk and sum(chunk_tokens) + tokens > max_tokens:
+                    # the overlap never pushes a chunk over the budget
+                    chunk, chunk_tokens = chunk[1:], chunk_tokens[1:]
+                chunk.append(part)
+                chunk_tokens.append(tokens)
+                new_pages += 1
+        if new_pages:
+            yield chunk
@@ -1,16 +1,15 @@
+import os
 import shutil
-import statistics
 import tempfile
-import uuid
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import List
 
 import streamlit as st
-from llama_index.core.schema import Document
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 
-from aistorybooks.phidataa.classic_stories import PhiStoryBookGenerator
+from aistorybooks.config import Config
+from aistorybooks.jobs import JobQueue, FINISHED_STATES, QUEUED, RUNNING
 
 
 @dataclass
@@ -27,6 +26,9 @@ class AppInputs:
     chunk_size: int = 10
     padding: int = 1
     skip_first_n_pages: int = 0
+    max_workers: int = 1
+    pipelined: bool = False
+    stream: bool = True
     language_options: List[str] = field(
         default_factory=lambda: ["German", "English", "Spanish", "French"]
     )
@@ -121,80 +123,156 @@ def st_sidebar(inputs: AppInputs):
             value=inputs.skip_first_n_pages,
             help="Number of pages to skip at the beginning of the novel (e.g., table of contents).",
         )
+        inputs.max_workers = st.number_input(
+            "Parallel Chunks",
+            min_value=1,
+            max_value=8,
+            value=inputs.max_workers,
+            help="Number of chunks processed at the same time. Higher values are faster but may hit rate limits.",
+        )
+        inputs.pipelined = st.checkbox(
+            "Pipelined",
+            value=inputs.pipelined,
+            help="Summarize the next chunk while the current one is being translated.",
+        )
+        inputs.stream = st.checkbox(
+            "Stream Output",
+            value=inputs.stream,
+            help="Show the translation while it is being written. Always pipelined, the chunks are then "
+                 "translated one at a time and Parallel Chunks only applies to the summaries.",
+        )
         submit_button = st.form_submit_button(label='Submit')
         return submit_button
 
 
-def st_process_file(inputs: AppInputs) -> List[List[Document]]:
-    uploaded_file_name = inputs.uploaded_file.name
-    st.info(f"Uploaded File: **{inputs.uploaded_file.name}**. Preparing your storybook... (Working in the background)."
-            f"  \nPlease note: Processing is powered by the free tier of Gemini, which may experience rate limiting.",
-            icon=":material/info:")
+@st.cache_resource
+def get_job_queue() -> JobQueue:
+    """Job queue shared by all sessions of the server, jobs keep running across reruns and page reloads."""
+    return JobQueue(max_workers=min(2, os.cpu_count() or 1))
 
+
+def st_process_file(inputs: AppInputs, job_queue: JobQueue) -> str:
+    """Submits the conversion of the uploaded file to the job queue and returns the job id."""
+    temp_folder = Path(tempfile.mkdtemp(prefix="story_gen_temp_"))
     try:
-        temp_folder = Path(tempfile.mkdtemp(prefix="story_gen_temp_"))
-        progress_value = 0
-        progress = st.progress(value=progress_value, text=f"Processing file...")
-        pdf_file = temp_folder.joinpath(uploaded_file_name)
-        md_file_name = f"{pdf_file.stem}.md"
-        # pdf_file_final = pdf_file.parent.joinpath(f"{pdf_file.stem}_story.pdf")
+        pdf_file = temp_folder.joinpath(inputs.uploaded_file.name)
         pdf_file.write_bytes(inputs.uploaded_file.getvalue())
-        generator = PhiStoryBookGenerator(
-            language=inputs.language,
-            level=inputs.level,
-            summary_size=inputs.summary_size,
-            writing_style=inputs.writing_style,
+        return job_queue.submit(
+            pdf_file=pdf_file,
+            generator_kwargs=dict(
+                language=inputs.language,
+                level=inputs.level,
+                summary_size=inputs.summary_size,
+                writing_style=inputs.writing_style,
+            ),
+            run_kwargs=dict(
+                chunk_size=inputs.chunk_size,
+                padding=inputs.padding,
+                skip_first_n_pages=inputs.skip_first_n_pages,
+                max_workers=inputs.max_workers,
+                pipelined=inputs.pipelined,
+                extraction_workers=min(4, os.cpu_count() or 1),
+                checkpoint_dir=str(Config.CACHE_DIR.joinpath("runs")),
+                resume=True,
+                stream=inputs.stream,
+            ),
         )
-        st.session_state[md_file_name] = ""
-        button_container = st.empty()
-        info_container = st.empty()
-        it = generator.run(pdf_file=pdf_file,
-                           chunk_size=inputs.chunk_size,
-                           padding=inputs.padding,
-                           skip_first_n_pages=inputs.skip_first_n_pages
-                           )
-        for response in it:
-            if response.event == "RunFailed":
-                st.error(f"{response.content}", icon=":material/error:")
-                progress.progress(value=progress_value, text=f"Error: {response.content}")
-            else:
-                progress_value = response.metrics['progress_percent']
-                progress.progress(value=progress_value, text=response.metrics['progress_info'])
-            st.session_state[md_file_name] += f"\n\n{response.content}"
-            button_container.empty()
-            button_container.download_button(label='Download Storybook as Markdown',
-                                             data=st.session_state.get(md_file_name),
-                                             file_name=md_file_name,
-                                             mime='text/markdown',
-                                             on_click="ignore",
-                                             key=str(uuid.uuid4()),
-                                             type="primary",
-                                             icon=":material/download:",
-                                             )
-            info_container.empty()
-            metrics = generator.model.metrics
-            avg_response_time = statistics.mean(metrics.get('response_times', [])) if metrics else 0
-            input_tokens = metrics.get('input_tokens', 0) if metrics else 0
-            output_tokens = metrics.get('output_tokens', 0) if metrics else 0
-            total_tokens = metrics.get('total_tokens', 0) if metrics else 0
-            info_container.info(f"Model: {generator.model.name} "
-                                f"  \n Avg response time: {avg_response_time} "
-                                f"  \n Input tokens: {input_tokens} "
-                                f"  \n Output tokens: {output_tokens} "
-                                f"  \n Total tokens: {total_tokens}",
-                                icon=":material/info:")
     finally:
-        if temp_folder and temp_folder.exists():
-            shutil.rmtree(temp_folder)
-            st.info(f"Temporary folder and its contents cleared", icon=":material/info:")
+        shutil.rmtree(temp_folder)
+
+
+def st_job_stats(stats: dict) -> str:
+    agents = "".join(
+        f"  \n {name.title()}: {agent['calls']} calls, {round(agent['seconds'], 1)}s, "
+        f"{agent['input_tokens']}/{agent['output_tokens']} input/output tokens, {agent['retries']} retries, "
+        f"{agent['cache_hits']} cache hits"
+        for name, agent in stats["agents"].items()
+    )
+    cache = stats.get("cache") or {"hits": 0, "misses": 0}
+    return (f"Model: {stats['model']} "
+            f"  \n Pages: {stats['pages']}, tokens per page: {stats['tokens_per_page']} "
+            f"  \n Extraction: {stats['seconds']['extraction']}s, queue wait: {stats['seconds']['queue_wait']}s"
+            f"{agents}"
+            f"  \n Cache hits/misses: {cache['hits']}/{cache['misses']} "
+            f"  \n Throttled: {stats['throttle']['throttled']} "
+            f"({stats['throttle']['throttle_seconds']}s), "
+            f"rate limit retries: {stats['throttle']['retries']}")
+
+
+def st_job_status(job_queue: JobQueue, job_id: str):
+    """
+    Shows the progress and output of a job, polling it while it is running. The storybook completed so far is
+    rendered once per page run, every poll then only sends the chunks completed since the previous poll and the
+    chunk being written.
+    """
+    try:
+        job = job_queue.status(job_id)
+    except KeyError:
+        st.error(f"Job {job_id} not found", icon=":material/error:")
+        return
+    polling = job["state"] not in FINISHED_STATES
+
+    pdf_name = Path(job["pdf_file"]).name
+    st.info(f"File: **{pdf_name}**. The job keeps running in the background when the page is reloaded."
+            f"  \nPlease note: Processing is powered by the free tier of Gemini, which may experience rate limiting.",
+            icon=":material/info:")
+    story = job_queue.story(job_id)
+    sent_key = f"story_sent_{job_id}"
+    st.session_state[sent_key] = story.size()
+
+    @st.fragment(run_every=1 if polling else None)
+    def job_view():
+        job = job_queue.status(job_id)
+        if polling and job["state"] in FINISHED_STATES:
+            # full rerun, stops the polling and renders the whole storybook
+            st.rerun()
+        st.progress(value=job["progress_percent"], text=f"{job['progress_info']} ({job['state']})")
+        if job["state"] in (QUEUED, RUNNING) and st.button("Cancel", key=f"cancel_{job_id}"):
+            job_queue.cancel(job_id)
+        for error in job["errors"]:
+            st.error(error, icon=":material/error:")
+        if job.get("stats"):
+            st.info(st_job_stats(job["stats"]), icon=":material/info:")
+
+    @st.fragment(run_every=1 if polling else None)
+    def story_tail():
+        # elements a fragment writes to a container outside of it add up across its reruns, only the chunks
+        # completed since the previous poll are sent
+        size = story.size()
+        if size > st.session_state[sent_key]:
+            story_container.markdown(story.read(st.session_state[sent_key], size))
+            st.session_state[sent_key] = size
+        st.markdown(job_queue.partial(job_id))
+
+    job_view()
+    story_container = st.container()
+    story_container.markdown(story.read(0, st.session_state[sent_key]))
+    if polling:
+        story_tail()
+
+    if job.get("error"):
+        st.error(job["error"], icon=":material/error:")
+    # a job failing or cancelled before its first chunk has no storybook file
+    if job["state"] in FINISHED_STATES and story.path.exists():
+        with story.open() as story_file:
+            st.download_button(label='Download Storybook as Markdown',
+                               data=story_file,
+                               file_name=f"{Path(pdf_name).stem}.md",
+                               mime='text/markdown',
+                               on_click="ignore",
+                               key=f"download_{job_id}",
+                               type="primary",
+                               icon=":material/download:",
+                               )
 
 
-def st_main_page(inputs: AppInputs):
+def st_main_page(inputs: AppInputs, submitted: bool = False):
     """
     Creates the main page for the Streamlit app and displays the input values.
 
     Args:
         inputs (AppInputs): An instance of the AppInputs data class.
+        submitted (bool): Whether the inputs form was submitted in this run.
     """
     st.title("Novel to Storybook Generator")
     st.write("---")
@@ -206,11 +284,18 @@ def st_main_page(inputs: AppInputs):
         **Writing Style:** {inputs.writing_style} | 
         **Chunk Size:** {inputs.chunk_size} | 
         **Padding:** {inputs.padding} | 
-        **Skip First N Pages:** {inputs.skip_first_n_pages}
+        **Skip First N Pages:** {inputs.skip_first_n_pages} | 
+        **Parallel Chunks:** {inputs.max_workers} | 
+        **Pipelined:** {inputs.pipelined} | 
+        **Stream Output:** {inputs.stream}
         """
     st.markdown(options_text)
-    if inputs.uploaded_file:
-        st_process_file(inputs=inputs)
+    job_queue = get_job_queue()
+    if submitted and inputs.uploaded_file:
+        # the job id lives in the url, a reloaded page reattaches to the running job
+        st.query_params["job"] = st_process_file(inputs=inputs, job_queue=job_queue)
+    if "job" in st.query_params:
+        st_job_status(job_queue=job_queue, job_id=st.query_params["job"])
 
 
 def st_set_css_and_footer():
@@ -281,9 +366,9 @@ def main():
     st_set_css_and_footer()
     inputs = AppInputs()
     with st.sidebar:
-        st_sidebar(inputs)
+        submitted = st_sidebar(inputs)
 
-    st_main_page(inputs)
+    st_main_page(inputs, submitted=submitted)
 
 
 if __name__ == "__main__":
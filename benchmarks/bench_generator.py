@@ -0,0 +1,122 @@
+"""
+Offline benchmark of `PhiStoryBookGenerator.run` against the local stub model, no API quota is used.
+
+Runs every combination of the given settings over the PDFs in tests/resources and reports pages/sec, the
+p50/p95 chunk latency (from the extraction of a chunk until it is completed, `ChunkTelemetry.total_seconds`)
+and the peak RSS of the run and its extraction workers. Every combination runs in a fresh process, so the
+peak RSS of one run doesn't carry over to the next.
+
+    python -m benchmarks.bench_generator --chunk-sizes 1,2 --paddings 0,1 --workers 1,4 --latency 0.2
+"""
+import argparse
+import itertools
+import json
+import pymupdf
+import resource
+import statistics
+import time
+from pathlib import Path
+from typing import List, Dict, Any
+
+from aistorybooks.osutils import spawn_process_pool
+from aistorybooks.phidataa.classic_stories import PhiStoryBookGenerator, OpenAILikeNoVerifySSL, CHUNK_PARTIAL_EVENT
+from aistorybooks.ratelimit import RateLimiter
+from benchmarks.stub_server import StubOpenAIServer, StubSettings
+
+RESOURCES_DIR = Path(__file__).parent.parent.joinpath("tests", "resources")
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def _percentile(values: List[float], percent: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(usage / 1024, 1)
+
+
+def run_benchmark(pdf_file: Path, base_url: str, **run_kwargs) -> Dict[str, Any]:
+    """Runs one configuration against the stub server at `base_url`, call it in a fresh process."""
+    generator = PhiStoryBookGenerator(
+        language="German",
+        level="B1 Intermediate",
+        model=OpenAILikeNoVerifySSL(id="stub", base_url=base_url, api_key="stub"),
+        # no limits, only the injected rate limit errors are retried
+        rate_limiter=RateLimiter(min_backoff=0.1, max_backoff=2),
+    )
+    with pymupdf.open(pdf_file) as doc:
+        pages = doc.page_count - run_kwargs.get("skip_first_n_pages", 0)
+    latencies = []
+    chunks = failed = 0
+    started_at = time.perf_counter()
+    for response in generator.run(pdf_file=pdf_file, **run_kwargs):
+        if response.event == CHUNK_PARTIAL_EVENT:
+            continue
+        latencies.append(response.metrics["telemetry"]["total_seconds"])
+        chunks += 1
+        if response.event == "RunFailed":
+            failed += 1
+    elapsed = time.perf_counter() - started_at
+    return {
+        "pdf": pdf_file.name,
+        **run_kwargs,
+        "chunks": chunks,
+        "failed": failed,
+        "seconds": round(elapsed, 3),
+        "pages_per_sec": round(pages / elapsed, 3) if elapsed else 0,
+        "p50_chunk_latency": round(_percentile(latencies, 50), 3),
+        "p95_chunk_latency": round(_percentile(latencies, 95), 3),
+        "retries": generator.rate_limiter.stats()["retries"],
+        "rate_limited": generator.rate_limiter.stats()["rate_limited"],
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pdf", type=Path, action="append", help="PDF files, defaults to tests/resources/*.pdf")
+    parser.add_argument("--chunk-sizes", type=_int_list, default=[1, 2])
+    parser.add_argument("--paddings", type=_int_list, default=[0, 1])
+    parser.add_argument("--workers", type=_int_list, default=[1, 4], help="max_workers settings")
+    parser.add_argument("--pipelined", action="store_true")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--latency", type=float, default=0.2, help="stub seconds to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=500)
+    parser.add_argument("--completion-tokens", type=int, default=200)
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0)
+    parser.add_argument("--json", type=Path, help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    pdf_files = args.pdf or sorted(RESOURCES_DIR.glob("*.pdf"))
+    settings = StubSettings(latency=args.latency, tokens_per_second=args.tokens_per_second,
+                            completion_tokens=args.completion_tokens,
+                            rate_limit_probability=args.rate_limit_probability, retry_after=0.1)
+    results = []
+    with StubOpenAIServer(settings) as server:
+        for pdf_file, chunk_size, padding, max_workers in itertools.product(pdf_files, args.chunk_sizes,
+                                                                            args.paddings, args.workers):
+            with spawn_process_pool(1) as executor:
+                result = executor.submit(run_benchmark, pdf_file, server.base_url, chunk_size=chunk_size,
+                                         padding=padding, max_workers=max_workers, pipelined=args.pipelined,
+                                         stream=args.stream).result()
+            results.append(result)
+            print(" ".join(f"{key}={value}" for key, value in result.items()), flush=True)
+        print(f"stub requests={server.requests} rate_limited={server.rate_limited}")
+        # every injected 429 has to reach the rate limiter, retries within the model client would hide them
+        counted = sum(result["rate_limited"] for result in results)
+        if counted != server.rate_limited:
+            raise SystemExit(f"rate limiter counted {counted} of the {server.rate_limited} injected rate limit errors")
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Import time benchmark, measures the cold import of the app and library modules in fresh interpreters and lists
+the heavy framework packages each import pulls in. A module that is not installed is reported as such.
+
+    python -m benchmarks.bench_imports --repeat 5
+"""
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, Any, List
+
+ROOT_DIR = Path(__file__).parent.parent
+MODULES = [
+    "aistorybooks.config",
+    "aistorybooks.jobs",
+    "aistorybooks.utils",
+    "aistorybooks.phidataa.classic_stories",
+    "app",
+]
+HEAVY_PACKAGES = ["streamlit", "llama_index", "phi", "google.generativeai", "pymupdf4llm", "openai", "crewai",
+                  "autogen", "chromadb"]
+
+_SCRIPT = """
+import json, sys, time
+started_at = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - started_at
+print(json.dumps({{"seconds": seconds, "loaded": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def measure(module: str, repeat: int) -> Dict[str, Any]:
+    """Imports `module` `repeat` times, each time in a new interpreter, and keeps the fastest run."""
+    runs: List[Dict[str, Any]] = []
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, "-c", _SCRIPT.format(module=module, heavy=HEAVY_PACKAGES)],
+                                 cwd=ROOT_DIR, capture_output=True, text=True)
+        if process.returncode != 0:
+            return {"module": module, "error": process.stderr.strip().splitlines()[-1]}
+        runs.append(json.loads(process.stdout.strip().splitlines()[-1]))
+    best = min(runs, key=lambda run: run["seconds"])
+    return {"module": module, "seconds": round(best["seconds"], 3), "loaded": ",".join(best["loaded"]) or "-"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--repeat", type=int, default=3, help="imports per module, the fastest one is reported")
+    args = parser.parse_args()
+
+    for module in args.modules:
+        result = measure(module, args.repeat)
+        print(" ".join(f"{key}={value}" for key, value in result.items()), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import json
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional
+
+
+@dataclass
+class StubSettings:
+    """Behaviour of the stub model."""
+    # seconds before the first token
+    latency: float = 0.5
+    # generated tokens per second, after the first token
+    tokens_per_second: float = 200
+    completion_tokens: int = 300
+    # probability of answering a request with 429 Too Many Requests
+    rate_limit_probability: float = 0.0
+    retry_after: float = 1.0
+    seed: int = 0
+
+
+class StubOpenAIServer:
+    """
+    Local OpenAI compatible chat completions server returning filler text, with configurable latency, token
+    rate and injected rate limit errors. Serves `POST /v1/chat/completions`, streaming and non streaming.
+
+    Usage:
+        with StubOpenAIServer(StubSettings(latency=0.2)) as server:
+            model = OpenAILikeNoVerifySSL(id="stub", base_url=server.base_url, api_key="stub")
+    """
+
+    def __init__(self, settings: Optional[StubSettings] = None, host: str = "127.0.0.1", port: int = 0):
+        self.settings = settings or StubSettings()
+        self.requests = 0
+        self.rate_limited = 0
+        self._random = random.Random(self.settings.seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "StubOpenAIServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub_openai_server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> "StubOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _should_rate_limit(self) -> bool:
+        with self._lock:
+            self.requests += 1
+            limited = self._random.random() < self.settings.rate_limit_probability
+            if limited:
+                self.rate_limited += 1
+            return limited
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status: int, body: dict, headers: dict = None):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                    return
+                settings = server.settings
+                if server._should_rate_limit():
+                    self._send_json(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                                    "code": "rate_limit_exceeded"}},
+                                    headers={"retry-after": str(settings.retry_after)})
+                    return
+
+                prompt = " ".join(str(message.get("content", "")) for message in request.get("messages", []))
+                prompt_tokens = max(1, len(prompt) // 4)
+                words = [f"word{i}" for i in range(settings.completion_tokens)]
+                completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+                model = request.get("model", "stub")
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                         "total_tokens": prompt_tokens + len(words)}
+                time.sleep(settings.latency)
+                if not request.get("stream"):
+                    time.sleep(len(words) / settings.tokens_per_second)
+                    self._send_json(200, {
+                        "id": completion_id, "object": "chat.completion", "created": int(time.time()),
+                        "model": model, "usage": usage,
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": " ".join(words)}}],
+                    })
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                def send_event(body):
+                    data = f"data: {body if isinstance(body, str) else json.dumps(body)}\n\n".encode("utf-8")
+                    self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                    self.wfile.flush()
+
+                def chunk(delta: dict, finish_reason=None, **extra) -> dict:
+                    return {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                            "model": model, **extra,
+                            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+                send_event(chunk({"role": "assistant", "content": ""}))
+                for i, word in enumerate(words):
+                    if i:
+                        time.sleep(1 / settings.tokens_per_second)
+                    send_event(chunk({"content": f"{word} "}))
+                send_event(chunk({}, finish_reason="stop", usage=usage))
+                send_event("[DONE]")
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+        return Handler
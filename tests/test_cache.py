@@ -0,0 +1,55 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from aistorybooks.cache import ResponseCache
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_file = Path(self.temp_dir.name).joinpath("responses.sqlite")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_get_put_counts_hits_and_misses(self):
+        cache = ResponseCache(path=self.cache_file)
+        key = ResponseCache.make_key("model", "description", "task", ResponseCache.hash_text("text"))
+
+        self.assertIsNone(cache.get(key))
+        cache.put(key, "summary")
+        self.assertEqual(cache.get(key), "summary")
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+        cache.close()
+
+        reopened = ResponseCache(path=self.cache_file)
+        self.assertEqual(reopened.get(key), "summary")
+        reopened.close()
+
+    def test_make_key_parts_are_not_ambiguous(self):
+        self.assertNotEqual(ResponseCache.make_key("ab", "c"), ResponseCache.make_key("a", "bc"))
+
+    def test_evicts_least_recently_used(self):
+        cache = ResponseCache(path=self.cache_file, max_entries=2)
+        cache.put("a", "1")
+        cache.put("b", "2")
+        cache.get("a")
+        cache.put("c", "3")
+
+        self.assertEqual(cache.get("a"), "1")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "3")
+        cache.close()
+
+    def test_expired_entries_are_misses(self):
+        cache = ResponseCache(path=self.cache_file, max_age_seconds=0.01)
+        cache.put("a", "1")
+        time.sleep(0.02)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["entries"], 0)
+        cache.close()
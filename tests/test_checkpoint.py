@@ -0,0 +1,26 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from aistorybooks.checkpoint import RunCheckpoint
+
+
+class TestRunCheckpoint(unittest.TestCase):
+
+    def test_save_and_load_chunks(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            params = {"language": "German", "chunk_size": 10}
+            checkpoint = RunCheckpoint.for_run("pdf-hash", params, root_dir=Path(root_dir))
+            checkpoint.save(0, 1, 11, content="Kapitel 1")
+
+            resumed = RunCheckpoint.for_run("pdf-hash", params, root_dir=Path(root_dir))
+            self.assertEqual(resumed.load(0, 1, 11), "Kapitel 1")
+            self.assertIsNone(resumed.load(0, 1, 12))
+            self.assertIsNone(resumed.load(1, 10, 21))
+            self.assertEqual(resumed.completed(), 1)
+
+            other = RunCheckpoint.for_run("pdf-hash", {**params, "language": "French"}, root_dir=Path(root_dir))
+            self.assertIsNone(other.load(0, 1, 11))
+
+            resumed.clear()
+            self.assertEqual(resumed.completed(), 0)
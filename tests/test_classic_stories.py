@@ -0,0 +1,395 @@
+import itertools
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from llama_index.core.schema import Document
+from phi.model.google.gemini import Gemini
+from phi.model.response import ModelResponse
+from phi.run.response import RunResponse
+
+from aistorybooks.cache import ResponseCache
+from aistorybooks.phidataa.classic_stories import (PhiStoryBookGenerator, OpenAILikeNoVerifySSL, CHUNK_PARTIAL_EVENT,
+                                                   _run_ordered, _run_pipelined)
+from aistorybooks.ratelimit import RateLimiter
+from aistorybooks.utils import CachedPages, PdfExtractionCache
+from benchmarks.stub_server import StubOpenAIServer, StubSettings
+
+PDF_FILE = Path(__file__).parent.joinpath("resources", "LoremIpsum.pdf")
+
+
+def _chunks(count: int, pages_per_chunk: int = 1):
+    """Chunks of `_iter_chunks`, without extracting a PDF."""
+    total_pages = count * pages_per_chunk
+    return [[Document(text=f"page {page}", extra_info={"page": page, "total_pages": total_pages})
+             for page in range(index * pages_per_chunk + 1, (index + 1) * pages_per_chunk + 1)]
+            for index in range(count)]
+
+
+def _patch_chunks(count: int, pages_per_chunk: int = 1):
+    return mock.patch.object(PhiStoryBookGenerator, "_iter_chunks",
+                             side_effect=lambda *args, **kwargs: iter(_chunks(count, pages_per_chunk)))
+
+
+class TestRunOrdered(unittest.TestCase):
+
+    def test_results_keep_input_order(self):
+        last_done = threading.Event()
+        in_flight = []
+        running = 0
+        lock = threading.Lock()
+
+        def square(item: int) -> int:
+            nonlocal running
+            with lock:
+                running += 1
+                in_flight.append(running)
+            # the first item only finishes after the last one of its window
+            if item == 0:
+                self.assertTrue(last_done.wait(timeout=5))
+            if item == 3:
+                last_done.set()
+            with lock:
+                running -= 1
+            return item * item
+
+        self.assertEqual(list(_run_ordered(square, range(10), max_workers=4)), [item * item for item in range(10)])
+        self.assertLessEqual(max(in_flight), 4)
+
+    def test_inline_without_workers(self):
+        threads = set()
+
+        def record(item: int) -> int:
+            threads.add(threading.current_thread())
+            return item
+
+        self.assertEqual(list(_run_ordered(record, range(3))), [0, 1, 2])
+        self.assertEqual(threads, {threading.current_thread()})
+
+
+class TestRunPipelined(unittest.TestCase):
+
+    def test_stages_overlap_and_keep_order(self):
+        summarized = []
+        second_stage_started = threading.Event()
+
+        def summarize(item: int) -> int:
+            # the next items are summarized while the first one is being translated
+            if item == 1:
+                self.assertTrue(second_stage_started.wait(timeout=5))
+            summarized.append(item)
+            return item
+
+        def translate(item: int) -> str:
+            second_stage_started.set()
+            return f"translated {item}"
+
+        results = list(_run_pipelined(summarize, translate, range(8), queue_size=2, max_workers=3))
+
+        self.assertEqual(results, [f"translated {item}" for item in range(8)])
+        self.assertEqual(sorted(summarized), list(range(8)))
+
+    def test_early_close_stops_the_first_stage(self):
+        summarized = []
+
+        def items():
+            for item in range(1_000):
+                summarized.append(item)
+                yield item
+
+        results = _run_pipelined(lambda item: item, lambda item: item, items(), queue_size=1)
+        self.assertEqual(next(results), 0)
+        # the producer is blocked on the full queue, closing must not wait for it to run through all items
+        closed = threading.Thread(target=results.close)
+        closed.start()
+        closed.join(timeout=5)
+        self.assertFalse(closed.is_alive())
+        self.assertLess(len(summarized), 10)
+        self.assertFalse(any(thread.name == "story_pipeline" for thread in threading.enumerate()))
+
+    def test_first_stage_errors_are_raised(self):
+        def summarize(item: int) -> int:
+            if item == 2:
+                raise ValueError("bad chunk")
+            return item
+
+        results = _run_pipelined(summarize, lambda item: item, range(5))
+        self.assertEqual([next(results), next(results)], [0, 1])
+        with self.assertRaises(ValueError):
+            next(results)
+
+
+class StubAgents:
+    """
+    Stands in for `PhiStoryBookGenerator._call_agent`, the author tags the text it is given and the translator
+    tags every summary in it, keeping the section markers of batches unless `merge_batches` is set. Every call
+    takes a second and 40 output tokens in the telemetry.
+    """
+
+    def __init__(self, fail_on: tuple = (), merge_batches: bool = False):
+        self.fail_on = fail_on
+        self.merge_batches = merge_batches
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, generator, agent, message: str, telemetry=None) -> RunResponse:
+        role = "summary" if agent.description.startswith("Expert author") else "translation"
+        with self._lock:
+            self.calls.append((role, message))
+        if telemetry is not None:
+            telemetry.add_call(1.0, metrics={"output_tokens": 40})
+        if message in self.fail_on:
+            return RunResponse(content=None)
+        if role == "summary":
+            return RunResponse(content=f"summary of {message}", metrics={})
+        if self.merge_batches and "<<<SECTION" in message:
+            return RunResponse(content="one translation of all sections", metrics={})
+        return RunResponse(content=message.replace("summary of", "translation of summary of"), metrics={})
+
+    def count(self, role: str) -> int:
+        return sum(1 for call_role, _ in self.calls if call_role == role)
+
+    def patch(self):
+        return mock.patch.object(PhiStoryBookGenerator, "_call_agent", autospec=True, side_effect=self)
+
+
+def _generator(**kwargs) -> PhiStoryBookGenerator:
+    return PhiStoryBookGenerator(model=Gemini(id="gemini", api_key="test"), rate_limiter=RateLimiter(), **kwargs)
+
+
+class TestPhiStoryBookGenerator(unittest.TestCase):
+
+    def test_run_yields_chunks_in_page_order(self):
+        agents = StubAgents()
+        with agents.patch(), _patch_chunks(6):
+            responses = list(_generator().run(pdf_file=PDF_FILE, chunk_size=1, padding=0, max_workers=3))
+        self.assertEqual([response.content for response in responses],
+                         [f"translation of summary of page {page}" for page in range(1, 7)])
+        self.assertEqual([response.metrics["progress_current_index"] for response in responses], list(range(1, 7)))
+        self.assertEqual(len(agents.calls), 12)
+
+    def test_run_closes_the_cached_pages(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            extraction_cache = PdfExtractionCache(cache_dir=Path(cache_dir))
+            pages = [page for chunk in _chunks(2) for page in chunk]
+            extraction_cache.save(PdfExtractionCache.key(PDF_FILE), pages).close()
+            for max_workers, responses_read in ((1, None), (2, 1)):
+                with StubAgents().patch(), mock.patch.object(CachedPages, "close", autospec=True,
+                                                             side_effect=CachedPages.close) as close:
+                    responses = _generator(extraction_cache=extraction_cache).run(
+                        pdf_file=PDF_FILE, chunk_size=1, padding=0, max_workers=max_workers)
+                    # a job stopped early closes the run before reading all responses
+                    self.assertEqual(len(list(itertools.islice(responses, responses_read))), responses_read or 2)
+                    self.assertEqual(close.call_count, 0 if responses_read else 1)
+                    responses.close()
+                    self.assertEqual(close.call_count, 1)
+
+    def test_completed_run_deletes_its_checkpoint(self):
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            with StubAgents(fail_on=("page 2",)).patch(), _patch_chunks(3):
+                responses = list(_generator().run(pdf_file=PDF_FILE, chunk_size=1, padding=0,
+                                                  checkpoint_dir=Path(checkpoint_dir)))
+            self.assertEqual([response.event for response in responses].count("RunFailed"), 1)
+            # the failed chunk is still to be resumed
+            self.assertEqual(len(list(Path(checkpoint_dir).glob("*/chunk_*.json"))), 2)
+
+            with StubAgents().patch(), _patch_chunks(3):
+                responses = list(_generator().run(pdf_file=PDF_FILE, chunk_size=1, padding=0,
+                                                  checkpoint_dir=Path(checkpoint_dir), resume=True))
+            self.assertEqual([response.content for response in responses],
+                             [f"translation of summary of page {page}" for page in (1, 2, 3)])
+            self.assertEqual(list(Path(checkpoint_dir).iterdir()), [])
+
+    def test_author_prompt_has_the_level_unless_summaries_are_shared(self):
+        self.assertIn("B1 Intermediate", _generator(level="B1 Intermediate").author_agent.task)
+        self.assertNotIn("B1 Intermediate",
+                         _generator(level="B1 Intermediate", shared_summaries=True).author_agent.task)
+
+    def test_shared_summaries_are_reused_for_other_targets(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            summary_cache = ResponseCache(Path(cache_dir, "summaries.sqlite"))
+            self.addCleanup(summary_cache.close)
+            for language, level in (("German", "A2 Elementary"), ("French", "B1 Intermediate")):
+                agents = StubAgents()
+                with agents.patch(), _patch_chunks(3):
+                    responses = list(_generator(language=language, level=level, summary_cache=summary_cache,
+                                                shared_summaries=True).run(pdf_file=PDF_FILE, chunk_size=1,
+                                                                           padding=0))
+                self.assertEqual([response.content for response in responses],
+                                 [f"translation of summary of page {page}" for page in (1, 2, 3)])
+            # only the translator runs for the second target
+            self.assertEqual(agents.count("summary"), 0)
+            self.assertEqual(agents.count("translation"), 3)
+
+
+class TestRunTargets(unittest.TestCase):
+
+    def test_author_runs_once_per_chunk(self):
+        agents = StubAgents()
+        targets = [("German", "A2 Elementary"), ("French", "B1 Intermediate")]
+        with agents.patch(), _patch_chunks(3):
+            responses = list(_generator().run_targets(pdf_file=PDF_FILE, targets=targets, chunk_size=1, padding=0,
+                                                      max_workers=2))
+
+        self.assertEqual(agents.count("summary"), 3)
+        self.assertEqual(agents.count("translation"), 6)
+        self.assertEqual([(response.metrics["language"], response.metrics["level"]) for response in responses],
+                         targets * 3)
+        self.assertEqual([response.content for response in responses],
+                         [f"translation of summary of page {page}" for page in (1, 1, 2, 2, 3, 3)])
+        self.assertEqual([response.metrics["progress_current_index"] for response in responses], [1, 1, 2, 2, 3, 3])
+
+    def test_summaries_are_shared_with_runs_of_shared_summaries(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            summary_cache = ResponseCache(Path(cache_dir, "summaries.sqlite"))
+            self.addCleanup(summary_cache.close)
+            with StubAgents().patch(), _patch_chunks(2):
+                list(_generator(summary_cache=summary_cache).run_targets(
+                    pdf_file=PDF_FILE, targets=[("German", "A2 Elementary")], chunk_size=1, padding=0))
+            agents = StubAgents()
+            with agents.patch(), _patch_chunks(2):
+                list(_generator(language="French", level="B1 Intermediate", summary_cache=summary_cache,
+                                shared_summaries=True).run(pdf_file=PDF_FILE, chunk_size=1, padding=0))
+            self.assertEqual(agents.count("summary"), 0)
+
+
+class TestTranslationBatches(unittest.TestCase):
+
+    def test_split_batch(self):
+        content = "<<<SECTION 1>>>\nEins\n\n <<<SECTION 2>>> \nZwei\nDrei\n"
+        self.assertEqual(PhiStoryBookGenerator._split_batch(content, 2), ["Eins", "Zwei\nDrei"])
+        self.assertEqual(PhiStoryBookGenerator._split_batch(f"Hier ist die Übersetzung:\n{content}", 2),
+                         ["Eins", "Zwei\nDrei"])
+
+    def test_split_batch_rejects_lost_markers(self):
+        for content in ("<<<SECTION 1>>>\nEins\nZwei",
+                        "<<<SECTION 2>>>\nZwei\n<<<SECTION 1>>>\nEins",
+                        "<<<SECTION 1>>>\nEins\n<<<SECTION 1>>>\nZwei",
+                        "<<<SECTION 1>>>\n\n<<<SECTION 2>>>\nZwei",
+                        "<<<SECTION 1>>> Eins\n<<<SECTION 2>>> Zwei"):
+            self.assertIsNone(PhiStoryBookGenerator._split_batch(content, 2), content)
+
+    def _run(self, agents: StubAgents) -> list:
+        with agents.patch(), _patch_chunks(4):
+            return list(_generator().run(pdf_file=PDF_FILE, chunk_size=1, padding=0,
+                                         translation_batch_tokens=1_000))
+
+    def test_run_translates_summaries_in_one_batch(self):
+        agents = StubAgents()
+        responses = self._run(agents)
+        self.assertEqual([response.content for response in responses],
+                         [f"translation of summary of page {page}" for page in range(1, 5)])
+        self.assertEqual([response.metrics["translation_batch_size"] for response in responses], [4] * 4)
+        self.assertEqual(agents.count("translation"), 1)
+        # the batch request is counted once, its time and tokens are shared by the chunks
+        translators = [response.metrics["telemetry"]["translator"] for response in responses]
+        self.assertEqual([translator["calls"] for translator in translators], [1, 0, 0, 0])
+        self.assertEqual([translator["seconds"] for translator in translators], [0.25] * 4)
+        self.assertEqual([translator["output_tokens"] for translator in translators], [10] * 4)
+
+    def test_run_translates_sections_one_by_one_when_markers_are_lost(self):
+        agents = StubAgents(merge_batches=True)
+        responses = self._run(agents)
+        self.assertEqual([response.content for response in responses],
+                         [f"translation of summary of page {page}" for page in range(1, 5)])
+        # the batch request, then one request per section
+        self.assertEqual(agents.count("translation"), 5)
+        # the failed batch request is shared by the chunks, like a successful one
+        translators = [response.metrics["telemetry"]["translator"] for response in responses]
+        self.assertEqual(sum(translator["calls"] for translator in translators), 5)
+        self.assertEqual([translator["seconds"] for translator in translators], [1.25] * 4)
+        self.assertEqual([translator["output_tokens"] for translator in translators], [50] * 4)
+
+
+class TestRunStream(unittest.TestCase):
+
+    @staticmethod
+    def _generator(server: StubOpenAIServer, **kwargs) -> PhiStoryBookGenerator:
+        return PhiStoryBookGenerator(model=OpenAILikeNoVerifySSL(id="stub", base_url=server.base_url, api_key="stub"),
+                                     rate_limiter=RateLimiter(sleep=lambda seconds: None), **kwargs)
+
+    @staticmethod
+    def _run(generator: PhiStoryBookGenerator, chunks: int = 2) -> list:
+        with _patch_chunks(chunks):
+            return list(generator.run(pdf_file=PDF_FILE, chunk_size=1, padding=0, stream=True))
+
+    @staticmethod
+    def _events(responses: list) -> list:
+        return [(response.event == CHUNK_PARTIAL_EVENT, response.metrics.get("progress_current_index"),
+                 response.content) for response in responses]
+
+    def test_partial_events_precede_the_complete_chunk(self):
+        with StubOpenAIServer(StubSettings(latency=0, tokens_per_second=10_000, completion_tokens=3)) as server:
+            responses = self._run(self._generator(server))
+        self.assertEqual(self._events(responses), [
+            (True, 1, "word0 "), (True, 1, "word1 "), (True, 1, "word2 "), (False, 1, "word0 word1 word2 "),
+            (True, 2, "word0 "), (True, 2, "word1 "), (True, 2, "word2 "), (False, 2, "word0 word1 word2 "),
+        ])
+        self.assertEqual(responses[3].metrics["telemetry"]["translator"]["calls"], 1)
+
+    def test_rate_limited_stream_is_restarted(self):
+        # with seed 10 the stub accepts the author request and answers the first translator request with 429
+        settings = StubSettings(latency=0, tokens_per_second=10_000, completion_tokens=2, rate_limit_probability=0.5,
+                                retry_after=0, seed=10)
+        with StubOpenAIServer(settings) as server:
+            responses = self._run(self._generator(server), chunks=1)
+        self.assertEqual(server.rate_limited, 1)
+        self.assertEqual(self._events(responses), [
+            (True, 1, ""), (True, 1, "word0 "), (True, 1, "word1 "), (False, 1, "word0 word1 "),
+        ])
+        self.assertTrue(responses[0].metrics["restarted"])
+        self.assertEqual(responses[-1].metrics["telemetry"]["translator"]["retries"], 1)
+
+    def test_cached_chunks_are_not_streamed(self):
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                StubOpenAIServer(StubSettings(latency=0, tokens_per_second=10_000, completion_tokens=3)) as server:
+            cache = ResponseCache(Path(cache_dir, "responses.sqlite"))
+            self.addCleanup(cache.close)
+            responses = self._run(self._generator(server, cache=cache))
+        # the stub writes the same summary for both chunks, the second translation comes from the cache
+        self.assertEqual(server.requests, 3)
+        self.assertEqual(self._events(responses), [
+            (True, 1, "word0 "), (True, 1, "word1 "), (True, 1, "word2 "), (False, 1, "word0 word1 word2 "),
+            (False, 2, "word0 word1 word2 "),
+        ])
+        self.assertEqual(responses[-1].metrics["telemetry"]["translator"]["cache_hits"], 1)
+
+    def test_stream_rejects_translation_batches(self):
+        with self.assertRaises(ValueError):
+            next(_generator().run(pdf_file=PDF_FILE, stream=True, translation_batch_tokens=1_000))
+
+
+class TestPhiStoryBookGeneratorAsync(unittest.IsolatedAsyncioTestCase):
+
+    async def _arun(self, generator: PhiStoryBookGenerator) -> list:
+        with _patch_chunks(2):
+            return [response async for response in generator.arun(pdf_file=PDF_FILE, chunk_size=1, padding=0,
+                                                                    max_concurrency=2)]
+
+    async def test_arun_openai_like_model(self):
+        settings = StubSettings(latency=0, tokens_per_second=10_000, completion_tokens=5)
+        with StubOpenAIServer(settings) as server:
+            generator = PhiStoryBookGenerator(
+                model=OpenAILikeNoVerifySSL(id="stub", base_url=server.base_url, api_key="stub"),
+                rate_limiter=RateLimiter(),
+            )
+            responses = await self._arun(generator)
+        self.assertEqual([response.event for response in responses if response.event == "RunFailed"], [])
+        self.assertEqual(len(responses), 2)
+        self.assertEqual(responses[0].content, "word0 word1 word2 word3 word4")
+        # author and translator call of every chunk
+        self.assertEqual(server.requests, 4)
+
+    async def test_arun_model_without_async_support(self):
+        # Gemini has no async api, its calls run in threads
+        with mock.patch.object(Gemini, "response", return_value=ModelResponse(content="Es war einmal")) as response:
+            generator = PhiStoryBookGenerator(model=Gemini(id="gemini", api_key="test"), rate_limiter=RateLimiter())
+            responses = await self._arun(generator)
+        self.assertEqual([response.content for response in responses], ["Es war einmal", "Es war einmal"])
+        self.assertEqual(response.call_count, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import asyncio
+import unittest
+
+from aistorybooks.httpclients import HttpClients
+from benchmarks.stub_server import StubOpenAIServer, StubSettings
+
+
+class TestHttpClients(unittest.TestCase):
+
+    def tearDown(self):
+        HttpClients.close()
+
+    def test_clients_are_shared(self):
+        client = HttpClients.httpx_client()
+        self.assertIs(HttpClients.httpx_client(), client)
+        # skipping TLS verification needs its own pool
+        self.assertIsNot(HttpClients.httpx_client(verify=False), client)
+
+    def test_configure_recreates_clients(self):
+        max_connections = HttpClients.max_connections
+        client = HttpClients.httpx_client()
+        try:
+            HttpClients.configure(max_connections=5)
+            # still held by the models and tools created before
+            self.assertFalse(client.is_closed)
+            self.assertIsNot(HttpClients.httpx_client(), client)
+            self.assertEqual(HttpClients.max_connections, 5)
+        finally:
+            HttpClients.configure(max_connections=max_connections)
+
+    def test_models_keep_working_after_configure(self):
+        from phi.agent import Agent
+        from aistorybooks.phidataa.classic_stories import OpenAILikeNoVerifySSL
+
+        max_connections = HttpClients.max_connections
+        with StubOpenAIServer(StubSettings(latency=0, tokens_per_second=10_000, completion_tokens=3)) as server:
+            model = OpenAILikeNoVerifySSL(id="stub", base_url=server.base_url, api_key="stub")
+            agent = Agent(model=model)
+            self.assertEqual(agent.run("hi").content, "word0 word1 word2")
+            try:
+                HttpClients.configure(max_connections=10)
+                self.assertEqual(agent.run("hi").content, "word0 word1 word2")
+            finally:
+                HttpClients.configure(max_connections=max_connections)
+        self.assertEqual(server.requests, 2)
+
+    def test_async_clients_are_shared_per_event_loop(self):
+        async def clients():
+            return HttpClients.async_httpx_client(), HttpClients.async_httpx_client()
+
+        first, same = asyncio.run(clients())
+        self.assertIs(first, same)
+        second, _ = asyncio.run(clients())
+        self.assertIsNot(second, first)
+
+
+if __name__ == '__main__':
+    unittest.main()
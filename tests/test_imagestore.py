@@ -0,0 +1,67 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from aistorybooks.imagestore import ImageStore
+
+
+class TestImageStore(unittest.TestCase):
+
+    @staticmethod
+    def _store_image(store: ImageStore, key: str, data: bytes) -> Path:
+        store.file_path(key).write_bytes(data)
+        return store.add(key)
+
+    def test_get_stored_image(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = ImageStore(Path(temp_dir))
+            key = ImageStore.make_key("prompt", "dall-e-3", "1024x1024", "standard")
+            self.assertNotEqual(key, ImageStore.make_key("prompt", "dall-e-3", "1024x1024", "hd"))
+            self.assertIsNone(store.get(key))
+
+            self._store_image(store, key, b"png")
+            self.assertEqual(store.get(key).read_bytes(), b"png")
+            # the index survives a restart
+            self.assertEqual(ImageStore(Path(temp_dir)).get(key).read_bytes(), b"png")
+            self.assertEqual(store.stats(), {"hits": 1, "misses": 1, "entries": 1, "size_bytes": 3})
+
+    def test_evicts_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = ImageStore(Path(temp_dir), max_entries=2)
+            self._store_image(store, "a", b"1")
+            self._store_image(store, "b", b"2")
+            store.get("a")
+            self._store_image(store, "c", b"3")
+
+            self.assertIsNone(store.get("b"))
+            self.assertFalse(store.file_path("b").exists())
+            self.assertIsNotNone(store.get("a"))
+            self.assertIsNotNone(store.get("c"))
+
+    def test_hits_dont_rewrite_the_index(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = ImageStore(Path(temp_dir), max_entries=2)
+            self._store_image(store, "a", b"1")
+            self._store_image(store, "b", b"2")
+            index_file = Path(temp_dir).joinpath(ImageStore.INDEX_FILE)
+            index = index_file.read_text(encoding="utf-8")
+
+            store.get("a")
+            self.assertEqual(index_file.read_text(encoding="utf-8"), index)
+            # the access order is saved with the next insert
+            self._store_image(store, "c", b"3")
+            self.assertEqual(list(json.loads(index_file.read_text(encoding="utf-8"))), ["a", "c"])
+
+    def test_evicts_by_size(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = ImageStore(Path(temp_dir), max_size_bytes=5)
+            self._store_image(store, "a", b"123")
+            self._store_image(store, "b", b"456")
+
+            self.assertIsNone(store.get("a"))
+            self.assertEqual(store.stats()["size_bytes"], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from aistorybooks.jobs import JobQueue, _JobFiles, QUEUED, RUNNING, COMPLETED, FAILED, INTERRUPTED
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def test_status_of_jobs_from_another_process(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            job_queue = JobQueue(root_dir=Path(root_dir), max_workers=1)
+            try:
+                running = _JobFiles(Path(root_dir).joinpath("running"))
+                running.job_dir.mkdir()
+                running.update(id="running", state=RUNNING, errors=[])
+                completed = _JobFiles(Path(root_dir).joinpath("completed"))
+                completed.job_dir.mkdir()
+                completed.update(id="completed", state=COMPLETED, errors=[])
+                completed.story.append("Kapitel 1")
+
+                self.assertEqual(job_queue.status("running")["state"], INTERRUPTED)
+                self.assertEqual(job_queue.status("completed")["state"], COMPLETED)
+                self.assertEqual(job_queue.result("completed"), "\n\nKapitel 1")
+                self.assertFalse(job_queue.cancel("completed"))
+                with self.assertRaises(KeyError):
+                    job_queue.status("unknown")
+            finally:
+                job_queue.shutdown()
+
+    def test_prune_deletes_expired_jobs(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            job_queue = JobQueue(root_dir=Path(root_dir), max_workers=1, retention_seconds=60)
+            try:
+                now = time.time()
+                for job_id, state, finished_at in (("expired", COMPLETED, now - 120), ("recent", FAILED, now - 30),
+                                                   ("interrupted", QUEUED, None)):
+                    files = _JobFiles(Path(root_dir).joinpath(job_id))
+                    files.job_dir.mkdir()
+                    files.update(id=job_id, state=state, submitted_at=now - 120, finished_at=finished_at, errors=[])
+                    files.story.append("Kapitel 1")
+
+                self.assertEqual(job_queue.prune(), 2)
+                self.assertEqual(sorted(path.name for path in Path(root_dir).iterdir()), ["recent"])
+                self.assertTrue(job_queue.delete("recent"))
+                self.assertEqual(list(Path(root_dir).iterdir()), [])
+            finally:
+                job_queue.shutdown()
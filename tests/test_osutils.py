@@ -0,0 +1,33 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from aistorybooks.osutils import write_atomic
+
+
+class TestWriteAtomic(unittest.TestCase):
+
+    def test_replaces_the_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file = Path(temp_dir).joinpath("job.json")
+            write_atomic(file, "{}")
+            write_atomic(file, '{"state": "running"}')
+
+            self.assertEqual(file.read_text(encoding="utf-8"), '{"state": "running"}')
+            self.assertEqual([path.name for path in Path(temp_dir).iterdir()], ["job.json"])
+
+    def test_failed_write_keeps_the_old_content(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file = Path(temp_dir).joinpath("job.json")
+            write_atomic(file, "{}")
+            with mock.patch("os.replace", side_effect=OSError("disk full")):
+                with self.assertRaises(OSError):
+                    write_atomic(file, '{"state": "running"}')
+
+            self.assertEqual(file.read_text(encoding="utf-8"), "{}")
+            self.assertEqual([path.name for path in Path(temp_dir).iterdir()], ["job.json"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+import unittest
+
+from aistorybooks.ratelimit import RateLimiter, TokenBucket, is_rate_limit_error, retry_after_seconds
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class RateLimitError(Exception):
+
+    def __init__(self, message: str = "429 Too Many Requests", retry_after: str = None):
+        super().__init__(message)
+        self.status_code = 429
+        self.response = type("Response", (), {"headers": {"retry-after": retry_after} if retry_after else {}})()
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_reserve_waits_when_empty(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate_per_minute=60, capacity=2, clock=clock)
+
+        self.assertEqual(bucket.reserve(1), 0)
+        self.assertEqual(bucket.reserve(1), 0)
+        self.assertAlmostEqual(bucket.reserve(1), 1.0)
+        self.assertAlmostEqual(bucket.reserve(1), 2.0)
+        clock.now += 10
+        self.assertEqual(bucket.reserve(1), 0)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_acquire_throttles_requests(self):
+        clock = FakeClock()
+        limiter = RateLimiter(requests_per_minute=2, sleep=clock.sleep, clock=clock)
+
+        for _ in range(3):
+            limiter.acquire()
+
+        self.assertEqual(limiter.stats()["throttled"], 1)
+        self.assertAlmostEqual(clock.sleeps[0], 30.0)
+
+    def test_call_retries_rate_limit_errors(self):
+        clock = FakeClock()
+        limiter = RateLimiter(requests_per_minute=60, sleep=clock.sleep, clock=clock)
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise RateLimitError(retry_after="5")
+            return "ok"
+
+        self.assertEqual(limiter.call(flaky), "ok")
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(limiter.stats()["retries"], 2)
+        self.assertIn(5.0, clock.sleeps)
+        self.assertLess(limiter.stats()["requests_per_minute"], 60)
+
+    def test_retrying_restarts_streams(self):
+        clock = FakeClock()
+        limiter = RateLimiter(requests_per_minute=60, sleep=clock.sleep, clock=clock)
+        received = []
+
+        def stream(fail: bool):
+            yield "a"
+            if fail:
+                raise RateLimitError(retry_after="2")
+            yield "b"
+
+        for attempt in limiter.retrying():
+            with attempt:
+                limiter.acquire()
+                received = list(stream(fail=attempt.retry_state.attempt_number == 1))
+                limiter.record_success()
+
+        self.assertEqual(received, ["a", "b"])
+        self.assertEqual(limiter.stats()["retries"], 1)
+        self.assertIn(2.0, clock.sleeps)
+
+    def test_call_does_not_retry_other_errors(self):
+        clock = FakeClock()
+        limiter = RateLimiter(sleep=clock.sleep, clock=clock)
+
+        def broken():
+            raise ValueError("bad request")
+
+        with self.assertRaises(ValueError):
+            limiter.call(broken)
+        self.assertEqual(limiter.stats()["retries"], 0)
+
+    def test_call_does_not_retry_errors_mentioning_429(self):
+        clock = FakeClock()
+        limiter = RateLimiter(sleep=clock.sleep, clock=clock)
+
+        def too_long():
+            raise ValueError("maximum context length is 8192 tokens, your messages resulted in 14290 tokens")
+
+        with self.assertRaises(ValueError):
+            limiter.call(too_long)
+        self.assertEqual(limiter.stats()["retries"], 0)
+        self.assertEqual(limiter.stats()["rate_limited"], 0)
+
+    def test_call_gives_up_after_max_retries(self):
+        clock = FakeClock()
+        limiter = RateLimiter(max_retries=2, sleep=clock.sleep, clock=clock)
+
+        def limited():
+            raise RateLimitError()
+
+        with self.assertRaises(RateLimitError):
+            limiter.call(limited)
+        self.assertEqual(limiter.stats()["rate_limited"], 2)
+
+    def test_error_helpers(self):
+        self.assertTrue(is_rate_limit_error(RateLimitError()))
+        self.assertTrue(is_rate_limit_error(Exception("429 Resource has been exhausted")))
+        self.assertFalse(is_rate_limit_error(Exception("400 Bad Request")))
+        self.assertTrue(is_rate_limit_error(Exception("Client error '429 Too Many Requests' for url 'https://x'")))
+        self.assertTrue(is_rate_limit_error(Exception("Too Many Requests (429)")))
+        self.assertTrue(is_rate_limit_error(Exception("status: RESOURCE_EXHAUSTED, quota exceeded")))
+        for message in ("This model's maximum context length is 8192 tokens, "
+                        "your messages resulted in 14290 tokens",
+                        "Internal error, request id 7f429ab1",
+                        "Failed to parse page 429 of the book",
+                        "Invalid value, see the rate limit guide for the allowed range"):
+            self.assertFalse(is_rate_limit_error(ValueError(message)), message)
+        self.assertEqual(retry_after_seconds(RateLimitError(retry_after="7")), 7.0)
+        self.assertEqual(retry_after_seconds(Exception("quota exceeded. Please retry in 23.5s.")), 23.5)
+        self.assertIsNone(retry_after_seconds(Exception("quota exceeded")))
+
+
+class TestAsyncRateLimiter(unittest.IsolatedAsyncioTestCase):
+
+    async def test_acall_retries_rate_limit_errors(self):
+        limiter = RateLimiter(requests_per_minute=600)
+        calls = []
+
+        async def flaky():
+            calls.append(1)
+            if len(calls) < 2:
+                raise RateLimitError(retry_after="0.01")
+            return "ok"
+
+        self.assertEqual(await limiter.acall(flaky), "ok")
+        self.assertEqual(limiter.stats()["retries"], 1)
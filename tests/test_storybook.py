@@ -0,0 +1,33 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from aistorybooks.storybook import StorybookBuffer
+
+
+class TestStorybookBuffer(unittest.TestCase):
+
+    def test_read_appended_chunks(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            story = StorybookBuffer(Path(temp_dir).joinpath("story.md"))
+            self.assertEqual(story.size(), 0)
+            self.assertEqual(story.read(), "")
+
+            story.append("Kapitel 1")
+            offset = story.size()
+            story.append("Kapitel 2 – Über")
+
+            self.assertEqual(len(story), 2)
+            self.assertEqual(story.read(), "\n\nKapitel 1\n\nKapitel 2 – Über")
+            self.assertEqual(story.read(offset), "\n\nKapitel 2 – Über")
+            self.assertEqual(story.read(story.size()), "")
+
+    def test_torn_chunk_is_not_visible(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            story = StorybookBuffer(Path(temp_dir).joinpath("story.md"))
+            story.append("Kapitel 1")
+            # a chunk still being written isn't in the index yet
+            with open(story.path, "ab") as f:
+                f.write("\n\nKapi".encode("utf-8"))
+
+            self.assertEqual(story.read(), "\n\nKapitel 1")
@@ -0,0 +1,56 @@
+import json
+import unittest
+import urllib.error
+import urllib.request
+
+from aistorybooks.phidataa.classic_stories import OpenAILikeNoVerifySSL
+from aistorybooks.ratelimit import RateLimiter
+from benchmarks.stub_server import StubOpenAIServer, StubSettings
+
+
+def _post(url: str, body: dict):
+    request = urllib.request.Request(url, data=json.dumps(body).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+    return urllib.request.urlopen(request, timeout=10)
+
+
+class TestStubOpenAIServer(unittest.TestCase):
+
+    def test_completion_and_stream(self):
+        settings = StubSettings(latency=0, tokens_per_second=10_000, completion_tokens=5)
+        with StubOpenAIServer(settings) as server:
+            url = f"{server.base_url}/chat/completions"
+            messages = [{"role": "user", "content": "Once upon a time"}]
+            with _post(url, {"model": "stub", "messages": messages}) as response:
+                completion = json.loads(response.read())
+            self.assertEqual(completion["choices"][0]["message"]["content"], "word0 word1 word2 word3 word4")
+            self.assertEqual(completion["usage"]["completion_tokens"], 5)
+
+            with _post(url, {"model": "stub", "messages": messages, "stream": True}) as response:
+                events = [line[len("data: "):] for line in response.read().decode("utf-8").splitlines()
+                          if line.startswith("data: ")]
+            self.assertEqual(events[-1], "[DONE]")
+            content = "".join(json.loads(event)["choices"][0]["delta"].get("content") or "" for event in events[:-1])
+            self.assertEqual(content, "word0 word1 word2 word3 word4 ")
+
+    def test_rate_limit_injection(self):
+        with StubOpenAIServer(StubSettings(latency=0, rate_limit_probability=1.0, retry_after=2)) as server:
+            with self.assertRaises(urllib.error.HTTPError) as error:
+                _post(f"{server.base_url}/chat/completions", {"messages": []})
+            self.assertEqual(error.exception.code, 429)
+            self.assertEqual(error.exception.headers["retry-after"], "2")
+            self.assertEqual(server.rate_limited, 1)
+
+    def test_rate_limiter_sees_injected_rate_limits(self):
+        settings = StubSettings(latency=0, tokens_per_second=10_000, completion_tokens=5,
+                                rate_limit_probability=0.5, retry_after=0.01, seed=1)
+        with StubOpenAIServer(settings) as server:
+            model = OpenAILikeNoVerifySSL(id="stub", base_url=server.base_url, api_key="stub")
+            client = model.get_client()
+            limiter = RateLimiter(min_backoff=0.01, max_backoff=0.05, max_retries=20)
+            for _ in range(5):
+                limiter.call(lambda: client.chat.completions.create(
+                    model="stub", messages=[{"role": "user", "content": "Once upon a time"}]))
+            self.assertGreater(server.rate_limited, 0)
+            self.assertEqual(limiter.stats()["rate_limited"], server.rate_limited)
+            self.assertEqual(server.requests, 5 + server.rate_limited)
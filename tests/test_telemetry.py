@@ -0,0 +1,65 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from aistorybooks.telemetry import (AgentTelemetry, ChunkTelemetry, TelemetrySummary, JsonlTelemetrySink,
+                                    PrometheusTelemetrySink, TelemetrySinks)
+
+
+def _chunk_telemetry(index: int, failed: bool = False) -> ChunkTelemetry:
+    telemetry = ChunkTelemetry(index=index, start_page=index * 2 + 1, end_page=index * 2 + 2, model="stub")
+    telemetry.author.add_call(2.0, attempts=3, metrics={"input_tokens": [100], "output_tokens": [40]})
+    telemetry.translator.add_call(1.0, metrics={"cache_hit": True})
+    telemetry.complete(failed=failed)
+    return telemetry
+
+
+class TestTelemetry(unittest.TestCase):
+
+    def test_shared_call(self):
+        telemetry = AgentTelemetry()
+        telemetry.add_call(3.0, metrics={"input_tokens": [90], "output_tokens": [30]}, share=1 / 3)
+
+        self.assertEqual(telemetry.calls, 1)
+        self.assertAlmostEqual(telemetry.seconds, 1.0)
+        self.assertEqual((telemetry.input_tokens, telemetry.output_tokens), (30, 10))
+
+    def test_add_share(self):
+        shared = AgentTelemetry()
+        shared.add_call(4.0, attempts=2, metrics={"input_tokens": [80], "output_tokens": [40]})
+        first, second = AgentTelemetry(), AgentTelemetry()
+        first.add_share(shared, share=1 / 2, count=True)
+        second.add_share(shared, share=1 / 2, count=False)
+
+        self.assertEqual([(telemetry.calls, telemetry.retries) for telemetry in (first, second)], [(1, 1), (0, 0)])
+        for telemetry in (first, second):
+            self.assertAlmostEqual(telemetry.seconds, 2.0)
+            self.assertEqual((telemetry.input_tokens, telemetry.output_tokens), (40, 20))
+
+    def test_summary(self):
+        summary = TelemetrySummary()
+        summary.record(_chunk_telemetry(0))
+        summary.record(_chunk_telemetry(1, failed=True))
+
+        stats = summary.to_dict()
+        self.assertEqual(stats["chunks"], {"ok": 1, "failed": 1, "resumed": 0})
+        self.assertEqual(stats["pages"], 4)
+        self.assertEqual(stats["agents"]["author"]["retries"], 4)
+        self.assertEqual(stats["agents"]["translator"]["cache_hits"], 2)
+        self.assertEqual(stats["tokens_per_page"], 70)
+
+    def test_sinks(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            jsonl = JsonlTelemetrySink(Path(temp_dir).joinpath("telemetry.jsonl"))
+            prometheus = PrometheusTelemetrySink(Path(temp_dir).joinpath("metrics.prom"))
+            sinks = TelemetrySinks(jsonl, prometheus)
+            sinks.record(_chunk_telemetry(0))
+            sinks.record(_chunk_telemetry(1))
+
+            lines = jsonl.path.read_text(encoding="utf-8").splitlines()
+            self.assertEqual([json.loads(line)["index"] for line in lines], [0, 1])
+            self.assertEqual(json.loads(lines[0])["author"]["input_tokens"], 100)
+            metrics = prometheus.path.read_text(encoding="utf-8")
+            self.assertIn('aistorybooks_chunks_total{model="stub",status="ok"} 2', metrics)
+            self.assertIn('aistorybooks_agent_tokens_total{model="stub",agent="author",direction="input"} 200', metrics)
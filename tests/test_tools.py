@@ -0,0 +1,184 @@
+import importlib.util
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+import pymupdf
+from openai import OpenAI
+
+# the crewai modules import their siblings as top level modules, appended so they don't shadow installed packages
+AISTORYBOOKS_DIR = Path(__file__).parent.parent.joinpath("aistorybooks")
+CREWAI_INSTALLED = all(importlib.util.find_spec(name) is not None for name in ("crewai", "markdown", "pdfkit"))
+if CREWAI_INSTALLED:
+    sys.path.extend([str(AISTORYBOOKS_DIR), str(AISTORYBOOKS_DIR.joinpath("crewaia"))])
+    import tools
+
+
+@unittest.skipUnless(CREWAI_INSTALLED, "crewai, markdown and pdfkit are not installed")
+class TestImageGenerator(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir.name)
+        self.addCleanup(os.chdir, cwd)
+
+    @staticmethod
+    def _download(image_url: str, filepath: Path) -> bool:
+        filepath.write_bytes(image_url.encode("utf-8"))
+        return True
+
+    def test_generate_batch_keeps_the_images_of_a_partly_failed_batch(self):
+        descriptions = [f"{name} " + "in a forest at dawn, painted with soft light " * 3
+                        for name in ("A fox", "A broken owl", "A bear")]
+
+        def generate(prompt: str, **kwargs):
+            if "broken" in prompt:
+                raise RuntimeError("content policy violation")
+            return SimpleNamespace(data=[SimpleNamespace(url=f"https://images/{prompt.split()[4]}")])
+
+        client = OpenAI(api_key="test")
+        generator = tools.ImageGenerator(client=client, max_concurrency=3,
+                                         image_store=tools.ImageStore(Path(self.temp_dir.name, "store")))
+        with mock.patch.object(client.images, "generate", side_effect=generate) as images_generate, \
+                mock.patch.object(tools.ImageGenerator, "_download", side_effect=self._download):
+            paths = generator.generate_batch(descriptions)
+
+            # stored images are served without calling the API again
+            self.assertEqual(generator.generate_batch([descriptions[0]]), [paths[0]])
+
+        self.assertEqual(paths[1], "")
+        self.assertTrue(paths[0].startswith("images/a_fox_in_a_forest_"))
+        self.assertEqual(Path(paths[0]).read_bytes(), b"https://images/fox")
+        self.assertEqual(Path(paths[2]).read_bytes(), b"https://images/bear")
+        self.assertEqual(images_generate.call_count, 3)
+
+
+class FakePdfkit:
+    """Stands in for `pdfkit.from_string`, writes a one page PDF naming the call and records the rendered html."""
+
+    def __init__(self):
+        self.html = []
+
+    def __call__(self, html: str, output_file: str, options=None):
+        self.html.append(html)
+        with pymupdf.open() as doc:
+            doc.new_page().insert_text((72, 72), f"part {len(self.html)}")
+            doc.save(output_file)
+        return True
+
+    def patch(self):
+        return mock.patch.object(tools.pdfkit, "from_string", side_effect=self)
+
+
+@unittest.skipUnless(CREWAI_INSTALLED, "crewai, markdown and pdfkit are not installed")
+class TestMarkdownToPdfConverter(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def _markdown_file(self, text: str, name: str = "story.md") -> str:
+        markdown_file = Path(self.temp_dir.name, name)
+        markdown_file.write_text(text, encoding="utf-8")
+        return markdown_file.as_posix()
+
+    @staticmethod
+    def _pages(pdf_file: str) -> list:
+        with pymupdf.open(pdf_file) as doc:
+            return [page.get_text().strip() for page in doc]
+
+    def test_stream_sections_splits_at_headings(self):
+        markdown_file = self._markdown_file(
+            "# Chapter 1\n\nOnce upon a time.\n\n### A scene\n\nIt rained.\n\n"
+            "# Chapter 2\n\nThe end.\n\n## Epilogue\n\nReally.\n")
+        pdfkit = FakePdfkit()
+        with pdfkit.patch():
+            pdf_file = tools.MarkdownToPdfConverter(stream_sections=True)._run(markdown_file)
+
+        self.assertEqual(len(pdfkit.html), 3)
+        self.assertIn("It rained.", pdfkit.html[0])
+        # the parts are appended in order
+        self.assertEqual(self._pages(pdf_file), ["part 1", "part 2", "part 3"])
+        self.assertEqual(list(Path(self.temp_dir.name).glob("tmp*")), [])
+
+    def test_stream_sections_splits_oversized_sections_at_paragraphs(self):
+        paragraph = "Once upon a time. " * 10
+        markdown_file = self._markdown_file("# Chapter 1\n\n" + f"{paragraph}\n\n" * 4)
+        pdfkit = FakePdfkit()
+        with pdfkit.patch():
+            pdf_file = tools.MarkdownToPdfConverter(stream_sections=True,
+                                                    max_section_chars=len(paragraph) * 2)._run(markdown_file)
+
+        self.assertEqual(len(pdfkit.html), 2)
+        self.assertEqual(self._pages(pdf_file), ["part 1", "part 2"])
+
+    def test_convert_batch_skips_unchanged_files(self):
+        markdown_files = [self._markdown_file(f"# Chapter {number}\n\nOnce upon a time.\n", f"story_{number}.md")
+                          for number in (1, 2)]
+        converter = tools.MarkdownToPdfConverter(max_workers=2)
+        pdfkit = FakePdfkit()
+        with pdfkit.patch():
+            first = converter.convert_batch(markdown_files)
+            second = converter.convert_batch(markdown_files)
+
+            Path(markdown_files[1]).write_text("# Chapter 2\n\nThe end.\n", encoding="utf-8")
+            changed = converter.convert_batch(markdown_files)
+            forced = converter.convert_batch(markdown_files[:1], force=True)
+
+        self.assertEqual([result["pdf_file"] for result in first],
+                         [Path(self.temp_dir.name, f"story_{number}.pdf").as_posix() for number in (1, 2)])
+        self.assertEqual([result["skipped"] for result in first], [False, False])
+        self.assertEqual([result["skipped"] for result in second], [True, True])
+        self.assertEqual([result["skipped"] for result in changed], [True, False])
+        self.assertEqual([result["skipped"] for result in forced], [False])
+        self.assertEqual(len(pdfkit.html), 4)
+        for result in first + second + changed + forced:
+            self.assertIsNone(result["error"])
+            self.assertGreaterEqual(result["seconds"], 0)
+
+    def test_convert_batch_rerenders_after_an_option_change(self):
+        markdown_file = self._markdown_file("# Chapter 1\n\nOnce upon a time.\n\n# Chapter 2\n\nThe end.\n")
+        pdfkit = FakePdfkit()
+        with pdfkit.patch():
+            tools.MarkdownToPdfConverter().convert_batch([markdown_file])
+            results = tools.MarkdownToPdfConverter(stream_sections=True).convert_batch([markdown_file])
+
+        self.assertFalse(results[0]["skipped"])
+        # one render of the whole file, then one per chapter
+        self.assertEqual(len(pdfkit.html), 3)
+        self.assertEqual(len(self._pages(results[0]["pdf_file"])), 2)
+
+    def test_convert_batch_reports_errors(self):
+        markdown_files = [self._markdown_file("# Chapter 1\n\nOnce upon a time.\n"),
+                          Path(self.temp_dir.name, "missing.md").as_posix(),
+                          self._markdown_file("# Broken\n", "broken.md")]
+
+        def from_string(html: str, output_file: str, options=None):
+            if "Broken" in html:
+                raise OSError("wkhtmltopdf exited with code 1")
+            return FakePdfkit()(html, output_file)
+
+        with mock.patch.object(tools.pdfkit, "from_string", side_effect=from_string):
+            results = tools.MarkdownToPdfConverter().convert_batch(markdown_files)
+
+        self.assertEqual([result["markdown_file"] for result in results], markdown_files)
+        self.assertIsNone(results[0]["error"])
+        self.assertTrue(Path(results[0]["pdf_file"]).exists())
+        self.assertIn("missing.md", results[1]["error"])
+        self.assertEqual(results[2]["error"], "wkhtmltopdf exited with code 1")
+        for result in results[1:]:
+            self.assertIsNone(result["pdf_file"])
+            self.assertFalse(result["skipped"])
+            self.assertGreaterEqual(result["seconds"], 0)
+        # a failed render leaves no hash behind, the next call tries again
+        self.assertFalse(tools.MarkdownToPdfConverter._hash_file(Path(self.temp_dir.name, "broken.pdf")).exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,12 @@
+import tempfile
 import unittest
 from llama_index.core.schema import Document
 from pathlib import Path
 from typing import List
+from unittest import mock
 
-from aistorybooks.utils import PdfUtil
+from aistorybooks.config import Config
+from aistorybooks.utils import PdfUtil, PdfExtractionCache
 
 
 @unittest.skip("Local user test only")
@@ -44,7 +47,103 @@ class TestPdfUtil(unittest.TestCase):
 
         self.assertEqual(len(chunks), 0)
 
+
+class TestPdfChunking(unittest.TestCase):
+
+    def test_split_document_into_chunks_views(self):
+        data = [Document(text=f"Page {i}") for i in range(1, 11)]
+
+        chunks = PdfUtil.split_document_into_chunks(data, chunk_size=5, padding=2)
+
+        self.assertIs(chunks[1].pages, data)
+        self.assertEqual((chunks[1].start, chunks[1].end), (3, 10))
+        self.assertEqual(chunks[0].text, "\n\n".join(f"Page {i}" for i in range(1, 8)))
+
+    def test_iter_document_chunks_streams_pages(self):
+        consumed = []
+
+        def pages():
+            for i in range(1, 11):
+                consumed.append(i)
+                yield Document(text=f"Page {i}")
+
+        chunks = PdfUtil.iter_document_chunks(pages(), chunk_size=5, padding=2)
+        first_chunk = next(chunks)
+        self.assertEqual([page.text for page in first_chunk], [f"Page {i}" for i in range(1, 8)])
+        self.assertEqual(len(consumed), 7)
+        self.assertEqual(len(list(chunks)), 1)
+
+    def test_iter_token_chunks(self):
+        data = [Document(text="word " * 100, extra_info={"page": i}) for i in range(1, 6)]
+
+        chunks = list(PdfUtil.iter_token_chunks(data, max_tokens=300, overlap_tokens=50))
+
+        self.assertEqual(len(chunks), 3)
+        for chunk in chunks:
+            self.assertLessEqual(sum(PdfUtil.estimate_tokens(doc.text) for doc in chunk), 300)
+        self.assertEqual([doc.extra_info["page"] for doc in chunks[1]], [2, 3, 4])
+        self.assertLessEqual(PdfUtil.estimate_tokens(chunks[1][0].text), 50)
+
+    def test_iter_token_chunks_splits_large_pages(self):
+        data = [Document(text="word " * 1000, extra_info={"page": 1})]
+
+        chunks = list(PdfUtil.iter_token_chunks(data, max_tokens=300))
+
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(sum(PdfUtil.estimate_tokens(doc.text) for doc in chunk), 300)
+            self.assertEqual(chunk[0].extra_info["page"], 1)
+
     def test_document_info(self):
         pdf_file = Path(__file__).parent.joinpath("resources/LoremIpsum.pdf")
-        document = PdfUtil.process_pdf_file(pdf_file=pdf_file, save_to_pickle=False)
-        print(document[0].extra_info)
+        with self.assertWarns(DeprecationWarning):
+            document = PdfUtil.process_pdf_file(pdf_file=pdf_file, save_to_pickle=False)
+        self.assertEqual(len(document), 9)
+        self.assertEqual(document[0].extra_info["page"], 1)
+        self.assertEqual(document[0].extra_info["total_pages"], 9)
+
+    def test_iter_pdf_pages_with_workers_matches_a_single_process(self):
+        pdf_file = Path(__file__).parent.joinpath("resources/LoremIpsum.pdf")
+        expected = list(PdfUtil.iter_pdf_pages(pdf_file))
+        # the 9 pages are split into ranges of 2 pages, spread over both workers
+        pages = list(PdfUtil.iter_pdf_pages(pdf_file, workers=2))
+
+        self.assertEqual(len(pages), 9)
+        self.assertEqual([page.text for page in pages], [page.text for page in expected])
+        self.assertEqual([page.extra_info for page in pages], [page.extra_info for page in expected])
+
+
+class TestPdfExtractionCache(unittest.TestCase):
+
+    def test_save_and_load_pages(self):
+        pages = [Document(text=f"Page {i}", extra_info={"page": i, "total_pages": 3}) for i in range(1, 4)]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = PdfExtractionCache(cache_dir=Path(cache_dir))
+            self.assertIsNone(cache.load("key"))
+            cache.save("key", pages).close()
+
+            loaded = cache.load("key", pdf_file=Path("book.pdf"))
+            self.assertEqual(len(loaded), 3)
+            self.assertEqual(loaded[1].text, "Page 2")
+            self.assertEqual(loaded[1].extra_info["page"], 2)
+            self.assertEqual(loaded[-1].extra_info["total_pages"], 3)
+            self.assertEqual(loaded[-1].extra_info["file_path"], "book.pdf")
+            self.assertEqual(loaded.text_range(0, 2), "Page 1\n\nPage 2")
+            self.assertEqual([page.text for page in loaded[1:]], ["Page 2", "Page 3"])
+            chunks = PdfUtil.split_document_into_chunks(loaded, chunk_size=2, padding=0)
+            self.assertEqual([chunk.text for chunk in chunks], ["Page 1\n\nPage 2", "Page 3"])
+            loaded.close()
+
+            with cache.load("key") as loaded:
+                self.assertEqual(loaded[0].text, "Page 1")
+            with self.assertRaises(ValueError):
+                loaded.text_range(0, 1)
+
+    def test_save_to_pickle_is_an_alias_of_use_cache(self):
+        pdf_file = Path(__file__).parent.joinpath("resources/LoremIpsum.pdf")
+        with tempfile.TemporaryDirectory() as cache_dir, mock.patch.object(Config, "CACHE_DIR", Path(cache_dir)):
+            with self.assertWarns(DeprecationWarning):
+                PdfUtil.process_pdf_file(pdf_file, save_to_pickle=True).close()
+            cache = PdfExtractionCache()
+            with cache.load(cache.key(pdf_file), pdf_file=pdf_file) as pages:
+                self.assertEqual(len(pages), 9)